@@ -0,0 +1,70 @@
+# coding=utf-8
+"""__main__.py - The command line interface of `louvijan`.
+
+    python -m louvijan serve                  # start the daemon
+    python -m louvijan submit pipeline.py     # or pipeline.json
+    python -m louvijan list
+    python -m louvijan cancel <id>
+"""
+import argparse
+import os
+import time
+
+
+def _format(job: dict) -> str:
+    started = time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(job['started'])) if job['started'] else '-'
+    return '{:>5}  {:<10} {:<20} {}'.format(job['id'], job['status'], started, job['path'])
+
+
+def main(argv=None) -> None:
+    from .server import DEFAULT_SOCKET
+
+    parser = argparse.ArgumentParser(prog='louvijan', description='The script pipeline tool.')
+    parser.add_argument('--socket', default=DEFAULT_SOCKET, help='The path of the Unix socket of the daemon.')
+    commands = parser.add_subparsers(dest='command', required=True)
+    serve = commands.add_parser('serve', help='Start the scheduler daemon.')
+    serve.add_argument('--workers', type=int, default=0,
+                       help='The maximum number of commands running at the same time, the number of CPUs by default.')
+    serve.add_argument('--pipelines', type=int, default=4,
+                       help='The maximum number of pipelines running at the same time.')
+    submit = commands.add_parser('submit', help='Submit a pipeline (`*.py` or `*.json`) to the daemon.')
+    submit.add_argument('path')
+    commands.add_parser('list', help='List the pipelines submitted to the daemon.')
+    cancel = commands.add_parser('cancel', help='Cancel a pipeline.')
+    cancel.add_argument('id', type=int)
+    args = parser.parse_args(argv)
+
+    if args.command == 'serve':
+        from .server import Server
+
+        try:
+            server = Server(args.socket, args.workers, args.pipelines)
+        except OSError as e:
+            parser.exit(1, '{}: error: {}\n'.format(parser.prog, e))
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            server.server_close()
+        return
+
+    from .server import request
+
+    try:
+        if args.command == 'submit':
+            job = request({'op': 'submit', 'path': os.path.abspath(args.path), 'cwd': os.getcwd()},
+                          args.socket)['job']
+            print('Submitted job {}.'.format(job['id']))
+        elif args.command == 'list':
+            for job in request({'op': 'list'}, args.socket)['jobs']:
+                print(_format(job))
+        elif args.command == 'cancel':
+            job = request({'op': 'cancel', 'id': args.id}, args.socket)['job']
+            print(_format(job))
+    except (RuntimeError, OSError) as e:
+        parser.exit(1, '{}: error: {}\n'.format(parser.prog, e))
+
+
+if __name__ == '__main__':
+    main()
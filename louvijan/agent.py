@@ -0,0 +1,458 @@
+# coding=utf-8
+"""agent.py - The worker agent of `louvijan` and its client.
+
+The agent is a small daemon running on a worker host, it keeps listening on a TCP port
+and executes the commands submitted by the coordinator, so that a remote task does not
+have to pay for the SSH handshake and channel setup every time.
+
+It also keeps a pool of warm Python workers, interpreters started in advance with the modules
+given by `--preload` already imported. A command like `python script.py args...`, whose `python`
+is the interpreter of the agent, is run by a warm worker without a shell or a cold interpreter.
+Each worker runs one script and exits, so that no state leaks between tasks, and is replaced
+in the background. Any other command is started with `/bin/sh -c`, like `subprocess.call(..., shell=True)`.
+
+Start it on the worker host with:
+
+    python -m louvijan.agent --port 7391 --token <secret> --pool 4 --preload numpy,pandas
+
+The protocol is a sequence of JSON lines:
+
+1. The agent sends `{"type": "challenge", "nonce": ...}`;
+2. The client answers `{"type": "auth", "digest": HMAC-SHA256(token, nonce)}`;
+3. The client sends `{"type": "run", "command": ...}`, the agent streams
+   `{"type": "output", "stream": "stdout"|"stderr", "data": ...}` messages and finishes with
+   `{"type": "exit", "status": ..., "rusage": {...}}`. Step 3 can be repeated on the same connection.
+   A malformed message is answered with `{"type": "error", "message": ...}`, and the connection stays open.
+"""
+import argparse
+import hashlib
+import hmac
+import json
+import os
+import secrets
+import shutil
+import signal
+import socket
+import socketserver
+import subprocess
+import sys
+import threading
+from queue import Queue, Empty
+from typing import Callable, Dict, Iterable, List, Optional, Tuple
+
+# The default port of the agent.
+DEFAULT_PORT = 7391
+
+# The characters that need a shell, a command containing any of them is never run by a warm worker
+_SHELL_CHARS = set('|&;<>()$`\\"\'*?[]{}~#!\n')
+
+# The code of a warm worker, `louvijan` is importable from wherever the agent imports it
+_WORKER = 'import sys; sys.path.insert(0, {!r}); import louvijan.agent; del sys.path[0]; ' \
+          'louvijan.agent._worker(sys.argv[1:])'.format(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+
+class AgentError(Exception):
+    """Raised when the agent refuses the connection or breaks the protocol.
+    """
+
+
+def _digest(token: str, nonce: str) -> str:
+    return hmac.new(token.encode('utf-8'), nonce.encode('utf-8'), hashlib.sha256).hexdigest()
+
+
+def _send(wfile, lock: threading.Lock, message: dict) -> None:
+    data = (json.dumps(message) + '\n').encode('utf-8')
+    with lock:
+        wfile.write(data)
+        wfile.flush()
+
+
+def _recv(rfile) -> dict:
+    line = rfile.readline()
+    if not line:
+        raise AgentError('Connection closed by peer.')
+    return json.loads(line.decode('utf-8'))
+
+
+def _python_argv(command: str) -> Optional[List[str]]:
+    """Return the arguments of the script if the command is `<python of the agent> script.py args...`.
+
+    Returns:
+        list: `sys.argv` of the script, None if the command must be run by the shell.
+    """
+
+    if _SHELL_CHARS & set(command):
+        return None
+    argv = command.split()
+    if len(argv) < 2 or not argv[1].endswith('.py'):
+        return None
+    executable = shutil.which(argv[0])
+    if executable is None or os.path.realpath(executable) != os.path.realpath(sys.executable):
+        return None
+    return argv[1:]
+
+
+def _worker(modules: List[str]) -> None:
+    """The main function of a warm worker.
+
+    Import the modules, wait for `{"argv": [...], "cwd": ...}` on stdin, then run the script
+    as `python script.py args...` would.
+    """
+
+    import importlib
+    import runpy
+
+    for name in modules:
+        try:
+            importlib.import_module(name)
+        except Exception:
+            # The script reports it if it needs the module
+            pass
+    line = sys.stdin.readline()
+    if not line:
+        # The agent is shutting down
+        return
+    job = json.loads(line)
+    script = job['argv'][0]
+    try:
+        if job.get('cwd'):
+            os.chdir(os.path.expanduser(job['cwd']))
+    except OSError as e:
+        sys.stderr.write('Unable to start the command: {}\n'.format(e))
+        sys.exit(127)
+    if not os.path.isfile(script):
+        sys.stderr.write("{}: can't open file '{}': No such file.\n".format(sys.executable, script))
+        sys.exit(2)
+    sys.argv = job['argv']
+    # As for `python script.py`, the imports resolve against the directory of the script first
+    sys.path[0] = os.path.dirname(os.path.abspath(script))
+    runpy.run_path(script, run_name='__main__')
+
+
+class _AgentHandler(socketserver.StreamRequestHandler):
+    """Serve one coordinator connection.
+    """
+
+    def handle(self) -> None:
+        lock = threading.Lock()
+        nonce = secrets.token_hex(16)
+        _send(self.wfile, lock, {'type': 'challenge', 'nonce': nonce})
+        try:
+            message = _recv(self.rfile)
+        except (AgentError, ValueError):
+            return
+        if message.get('type') != 'auth' or \
+                not hmac.compare_digest(str(message.get('digest', '')), _digest(self.server.token, nonce)):
+            _send(self.wfile, lock, {'type': 'error', 'message': 'Authentication failed.'})
+            return
+        _send(self.wfile, lock, {'type': 'ready'})
+
+        while True:
+            try:
+                message = _recv(self.rfile)
+            except (AgentError, ValueError, OSError):
+                return
+            try:
+                if not isinstance(message, dict):
+                    _send(self.wfile, lock, {'type': 'error', 'message': 'The message must be an object.'})
+                elif message.get('type') == 'run':
+                    if not isinstance(message.get('command'), str) or not message['command']:
+                        _send(self.wfile, lock, {'type': 'error', 'message': 'The command to run is missing.'})
+                        continue
+                    # The number of tasks running at the same time is limited by the size of the pool.
+                    with self.server.slots:
+                        status, rusage = self.run(message['command'], message.get('cwd'), lock)
+                    _send(self.wfile, lock, {'type': 'exit', 'status': status, 'rusage': rusage})
+                elif message.get('type') == 'ping':
+                    _send(self.wfile, lock, {'type': 'pong'})
+                else:
+                    _send(self.wfile, lock, {'type': 'error', 'message': 'Unknown message type.'})
+            except OSError:
+                # The coordinator is gone
+                return
+
+    def run(self, command: str, cwd: Optional[str], lock: threading.Lock) -> Tuple[int, Optional[dict]]:
+        """Execute the command and stream its output back to the coordinator.
+
+        Args:
+            command (str): The command to execute.
+            cwd (str): The working directory of the command, `~` is expanded, the agent's one if null.
+            lock (threading.Lock): Serializes the writes to the connection.
+
+        Returns:
+            tuple: The exit status and the resource usage of the command.
+            If the command can't be started (e.g. missing `cwd`), the status is 127, as the shell
+            returns for a command not found, and the reason is sent as the error output.
+        """
+
+        argv = _python_argv(command)
+        proc = self.server.worker() if argv else None
+        if proc is not None:
+            try:
+                proc.stdin.write((json.dumps({'argv': argv, 'cwd': cwd}) + '\n').encode('utf-8'))
+                proc.stdin.close()
+            except OSError:
+                # The worker died, e.g. killed on the host
+                self.kill(proc)
+                proc.wait()
+                proc = None
+        if proc is None:
+            try:
+                # The command runs in its own process group, so that it can be killed with its children.
+                proc = subprocess.Popen(command, shell=True, cwd=cwd and os.path.expanduser(cwd),
+                                        start_new_session=hasattr(os, 'killpg'),
+                                        stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+            except (OSError, TypeError, ValueError) as e:
+                _send(self.wfile, lock, {'type': 'output', 'stream': 'stderr',
+                                         'data': 'Unable to start the command: {}\n'.format(e)})
+                return 127, None
+        dropped = threading.Event()
+
+        def pump(stream, name):
+            for line in iter(stream.readline, b''):
+                if dropped.is_set():
+                    # Keep draining the pipe, so that the command never blocks on writing
+                    continue
+                try:
+                    _send(self.wfile, lock, {'type': 'output', 'stream': name,
+                                             'data': line.decode('utf-8', 'replace')})
+                except OSError:
+                    # The coordinator is gone, nobody waits for the command any more
+                    dropped.set()
+                    self.kill(proc)
+            stream.close()
+
+        pumps = [threading.Thread(target=pump, args=(proc.stdout, 'stdout'), daemon=True),
+                 threading.Thread(target=pump, args=(proc.stderr, 'stderr'), daemon=True)]
+        for t in pumps:
+            t.start()
+        for t in pumps:
+            t.join()
+
+        rusage = None
+        if hasattr(os, 'wait4'):
+            # `wait4` reaps the child and reports its own resource usage.
+            _, status, usage = os.wait4(proc.pid, 0)
+            proc.returncode = os.waitstatus_to_exitcode(status)
+            rusage = {'utime': usage.ru_utime, 'stime': usage.ru_stime, 'maxrss': usage.ru_maxrss}
+        else:
+            proc.wait()
+        return proc.returncode, rusage
+
+    @staticmethod
+    def kill(proc: subprocess.Popen) -> None:
+        """Kill the command and the processes it started.
+        """
+
+        try:
+            if hasattr(os, 'killpg'):
+                os.killpg(proc.pid, signal.SIGKILL)
+            else:
+                proc.kill()
+        except OSError:
+            pass
+
+
+class AgentServer(socketserver.ThreadingTCPServer):
+    """The agent daemon, a threading TCP server executing commands for the coordinator.
+    """
+
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, token: str, host: str = '0.0.0.0', port: int = DEFAULT_PORT, workers: int = 0,
+                 pool: int = 0, preload: Iterable[str] = ()) -> None:
+        """Initialize the server.
+
+        Args:
+            token (str): The shared secret used to authenticate the coordinator.
+            host (str): The address to bind.
+            port (int): The port to bind, 0 means a free port is chosen.
+            workers (int): The maximum number of commands running at the same time,
+            if 0, the number of CPUs is used.
+            pool (int): The number of warm Python workers kept ready, 0 disables them.
+            preload (iterable): The modules imported by the warm workers in advance.
+        """
+
+        if not token:
+            raise ValueError("The token of agent can't be None.")
+        self.token = token
+        self.slots = threading.BoundedSemaphore(workers or os.cpu_count() or 1)
+        self.preload = list(preload)
+        self.__pool = pool
+        self.__idle = Queue()
+        self.__closed = False
+        super().__init__((host, port), _AgentHandler)
+        for _ in range(pool):
+            self.__idle.put(self.__spawn())
+
+    def __spawn(self) -> subprocess.Popen:
+        # In its own process group, as the commands started by the shell
+        return subprocess.Popen([sys.executable, '-c', _WORKER] + self.preload,
+                                start_new_session=hasattr(os, 'killpg'), stdin=subprocess.PIPE,
+                                stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+
+    def __refill(self) -> None:
+        proc = self.__spawn()
+        self.__idle.put(proc)
+        if self.__closed:
+            self.__drain()
+
+    def __drain(self) -> None:
+        while True:
+            try:
+                proc = self.__idle.get_nowait()
+            except Empty:
+                break
+            _AgentHandler.kill(proc)
+            proc.wait()
+            for stream in (proc.stdin, proc.stdout, proc.stderr):
+                stream.close()
+
+    def worker(self) -> Optional[subprocess.Popen]:
+        """Take a warm worker from the pool and start its replacement in the background.
+
+        Returns:
+            subprocess.Popen: The worker, None if no worker is ready.
+        """
+
+        if not self.__pool or self.__closed:
+            return None
+        try:
+            proc = self.__idle.get_nowait()
+        except Empty:
+            return None
+        threading.Thread(target=self.__refill, daemon=True).start()
+        if proc.poll() is not None:
+            return None
+        return proc
+
+    def server_close(self) -> None:
+        super().server_close()
+        self.__closed = True
+        self.__drain()
+
+
+class AgentClient:
+    """Submit commands to a remote `AgentServer`.
+
+    Connections are kept in a pool and reused, so parallel tasks
+    only pay for the TCP handshake and the authentication once per connection.
+    """
+
+    def __init__(self, host: str, port: int = DEFAULT_PORT, token: str = '', timeout: float = 5) -> None:
+        self.host = host
+        self.port = int(port)
+        self.token = token
+        self.timeout = timeout
+        self.__idle = Queue()
+
+    def __open(self) -> Tuple[socket.socket, object]:
+        sock = socket.create_connection((self.host, self.port), timeout=self.timeout)
+        rfile = sock.makefile('rb')
+        try:
+            message = _recv(rfile)
+            if message.get('type') != 'challenge':
+                raise AgentError('Unexpected message from agent: {}.'.format(message))
+            sock.sendall((json.dumps({'type': 'auth',
+                                      'digest': _digest(self.token, message['nonce'])}) + '\n').encode('utf-8'))
+            message = _recv(rfile)
+            if message.get('type') != 'ready':
+                raise AgentError(message.get('message', 'Authentication failed.'))
+        except Exception:
+            rfile.close()
+            sock.close()
+            raise
+        # The commands may run for a long time.
+        sock.settimeout(None)
+        return sock, rfile
+
+    def __acquire(self) -> Tuple[socket.socket, object]:
+        try:
+            return self.__idle.get_nowait()
+        except Empty:
+            return self.__open()
+
+    def ping(self) -> None:
+        """Check that the agent is reachable and accepts the token.
+        """
+
+        sock, rfile = self.__acquire()
+        try:
+            sock.sendall(b'{"type": "ping"}\n')
+            if _recv(rfile).get('type') != 'pong':
+                raise AgentError('Unexpected answer to ping.')
+        except Exception:
+            rfile.close()
+            sock.close()
+            raise
+        self.__idle.put((sock, rfile))
+
+    def run(self, command: str, on_output: Callable[[str, str], None] = None,
+            cwd: str = None) -> Tuple[int, Optional[Dict[str, float]]]:
+        """Run the command on the agent.
+
+        Args:
+            command (str): The command to run.
+            on_output (callable): Called with `(stream, line)` for each line of output.
+            cwd (str): The working directory on the agent.
+
+        Returns:
+            tuple: The exit status and the resource usage reported by the agent.
+        """
+
+        sock, rfile = self.__acquire()
+        try:
+            sock.sendall((json.dumps({'type': 'run', 'command': command, 'cwd': cwd}) + '\n').encode('utf-8'))
+            while True:
+                message = _recv(rfile)
+                if message['type'] == 'output':
+                    on_output and on_output(message['stream'], message['data'])
+                elif message['type'] == 'exit':
+                    break
+                else:
+                    raise AgentError(message.get('message', 'Unexpected message from agent.'))
+        except Exception:
+            rfile.close()
+            sock.close()
+            raise
+        self.__idle.put((sock, rfile))
+        return message['status'], message.get('rusage')
+
+    def close(self) -> None:
+        """Close all the idle connections.
+        """
+
+        while True:
+            try:
+                sock, rfile = self.__idle.get_nowait()
+            except Empty:
+                break
+            rfile.close()
+            sock.close()
+
+
+def main(argv=None) -> None:
+    parser = argparse.ArgumentParser(prog='louvijan-agent', description='The worker agent of louvijan.')
+    parser.add_argument('--host', default='0.0.0.0', help='The address to bind.')
+    parser.add_argument('--port', type=int, default=DEFAULT_PORT, help='The port to bind.')
+    parser.add_argument('--token', default=os.environ.get('LOUVIJAN_AGENT_TOKEN', ''),
+                        help='The shared secret, `LOUVIJAN_AGENT_TOKEN` by default.')
+    parser.add_argument('--workers', type=int, default=0, help='The maximum number of running commands.')
+    parser.add_argument('--pool', type=int, default=2, help='The number of warm Python workers, 0 disables them.')
+    parser.add_argument('--preload', default='',
+                        help='The modules imported by the warm workers, separated by commas, e.g. `numpy,pandas`.')
+    args = parser.parse_args(argv)
+
+    server = AgentServer(args.token, args.host, args.port, args.workers, args.pool,
+                         [i.strip() for i in args.preload.split(',') if i.strip()])
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+
+if __name__ == '__main__':
+    main()
@@ -1 +1,87 @@
 # coding=utf-8
+"""The managers of `louvijan`, which are regarded as plugins.
+
+Each manager is bound to a section of the configuration file, and its module is only imported
+when the section is present, so that e.g. `paramiko` is never imported by pipelines without `[remote]`.
+
+Third-party managers are registered through the entry point group `louvijan.managers`,
+where the name of the entry point is the section, e.g. in `setup.py`:
+
+    entry_points={'louvijan.managers': ['slack = louvijan_slack:SlackManager']}
+"""
+import importlib
+
+# The entry point group of third-party managers
+ENTRY_POINT_GROUP = 'louvijan.managers'
+
+# The built-in managers: section => `module:class`
+MANAGERS = {
+    'execution': 'louvijan.manager.execution:ExecutionManager',
+    'log': 'louvijan.manager.log:LogManager',
+    'email': 'louvijan.manager.mail:EMailManager',
+    'remote': 'louvijan.manager.remote:RemoteManager',
+    'metrics': 'louvijan.manager.metrics:MetricsManager',
+}
+
+# The loaded manager classes, keyed by section
+_loaded = {}
+# The entry points of third-party managers, discovered on first use
+_entry_points = None
+
+
+def _discover() -> dict:
+    """Find the third-party managers registered under `ENTRY_POINT_GROUP`.
+    """
+
+    global _entry_points
+    if _entry_points is None:
+        from importlib import metadata
+
+        try:
+            eps = metadata.entry_points(group=ENTRY_POINT_GROUP)
+        except TypeError:
+            # Python < 3.10
+            eps = metadata.entry_points().get(ENTRY_POINT_GROUP, [])
+        _entry_points = {ep.name: ep for ep in eps}
+    return _entry_points
+
+
+def get_manager(section: str):
+    """Return the manager class of the section, importing its module if needed.
+
+    Args:
+        section (str): The section of `***.conf` file.
+
+    Returns:
+        class: The subclass of `PluginManager`, None if no manager is registered for the section.
+    """
+
+    if section not in _loaded:
+        if section in MANAGERS:
+            module, name = MANAGERS[section].split(':')
+            _loaded[section] = getattr(importlib.import_module(module), name)
+        elif section in _discover():
+            _loaded[section] = _discover()[section].load()
+        else:
+            return None
+    return _loaded[section]
+
+
+def load_managers(configManager, required=('execution', 'log')) -> dict:
+    """Instantiate the managers of the sections present in the configuration.
+
+    Args:
+        configManager (Config): Class `Config` instance.
+        required (tuple): The sections whose manager is always instantiated, even if absent.
+
+    Returns:
+        dict: The manager instances, keyed by section.
+    """
+
+    sections = list(required) + [s for s in configManager.manager.sections() if s not in required]
+    managers = {}
+    for section in sections:
+        cls = get_manager(section)
+        if cls is not None:
+            managers[section] = cls(configManager)
+    return managers
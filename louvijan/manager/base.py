@@ -8,7 +8,9 @@ from typing import Union
 class PluginManager:
     """The base class of Manager, inherit it to extend the function of `Pipeline`.
 
-    Its subclasses can be regarded as plugins, controlled by configuration files.
+    Its subclasses can be regarded as plugins, controlled by configuration files,
+    see `louvijan.manager` for how they are registered. They can override the hooks `on_*`,
+    which are called by `PipeLine` during the execution.
     """
 
     def __init__(self, name, configManager: Config) -> None:
@@ -43,6 +45,35 @@ class PluginManager:
             return int(res)
         return res
 
+    def on_dispatch(self, pipeline) -> None:
+        """Called when the `PipeLine` starts to dispatch its tasks.
 
+        Args:
+            pipeline (PipeLine): The `PipeLine` object.
+        """
+
+    def on_task_start(self, pipeline, command: str) -> None:
+        """Called before a command is executed.
+
+        Args:
+            pipeline (PipeLine): The `PipeLine` object.
+            command (str): The command to execute.
+        """
 
+    def on_task_skip(self, pipeline, command: str) -> None:
+        """Called instead of `on_task_start` for a command which is not executed, e.g. its job is cancelled.
 
+        Args:
+            pipeline (PipeLine): The `PipeLine` object.
+            command (str): The command skipped.
+        """
+
+    def on_task_end(self, pipeline, command: str, ret: int, cost: float) -> None:
+        """Called after a command is executed.
+
+        Args:
+            pipeline (PipeLine): The `PipeLine` object.
+            command (str): The command executed.
+            ret (int): Status code returned by executing the command.
+            cost (float): The elapsed seconds.
+        """
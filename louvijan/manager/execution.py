@@ -1,13 +1,195 @@
 # coding=utf-8
 """execution.py - This module provides classes that execute commands.
 """
+import errno
 import os
+import shlex
+import shutil
 import sys
 import signal
 import subprocess
+import tempfile
+import threading
+import time
+import uuid
 from .config import Config
 from .base import PluginManager
 from .log import LogManager
+from typing import Dict, List, Optional, Set
+
+# The classes of I/O scheduling, as `ionice`
+IOPRIO_CLASSES = {'realtime': 1, 'best-effort': 2, 'idle': 3}
+# The number of the `ioprio_set` system call on the common architectures
+IOPRIO_SET = {'x86_64': 251, 'aarch64': 30, 'i686': 289, 'i386': 289, 'armv7l': 314, 'ppc64le': 273}
+# The options of placement, which can be set in the `[execution]` section or for a task
+PLACEMENT_OPTIONS = ('cpus', 'nice', 'ionice', 'cgroup', 'cpu_max', 'memory_max')
+
+
+def parse_cpus(cpus: str) -> Set[int]:
+    """Parse a CPU list.
+
+    Args:
+        cpus (str): CPU list in the format of `taskset`.
+
+    Returns:
+        set: The CPU numbers.
+
+    Examples:
+        >>> sorted(parse_cpus('0-2, 5'))
+        [0, 1, 2, 5]
+    """
+
+    res = set()
+    for part in str(cpus).split(','):
+        part = part.strip()
+        if not part:
+            continue
+        try:
+            if '-' in part:
+                low, high = part.split('-')
+                res.update(range(int(low), int(high) + 1))
+            else:
+                res.add(int(part))
+        except ValueError:
+            raise ValueError('`cpus` must be a CPU list like `0-3,6`.')
+    return res
+
+
+def partition_cpus(cpus: Set[int], n: int) -> List[Set[int]]:
+    """Split the CPUs into `n` disjoint sets, or share them round-robin if there are fewer CPUs than `n`.
+
+    Examples:
+        >>> partition_cpus({0, 1, 2, 3}, 2)
+        [{0, 1}, {2, 3}]
+    """
+
+    cpus = sorted(cpus)
+    if len(cpus) < n:
+        return [{cpus[i % len(cpus)]} for i in range(n)]
+    return [set(cpus[i * len(cpus) // n:(i + 1) * len(cpus) // n]) for i in range(n)]
+
+
+class AdaptiveConcurrency:
+    """Adapt the number of parallel tasks to the load of the host (AIMD).
+
+    The load of the host is sampled from `/proc/loadavg`, `/proc/meminfo` and `/proc/pressure`.
+    The decisions rely on the instantaneous signals (runnable tasks, available memory and the
+    pressure over the last 10 seconds); the 1-minute load average lags too much and is only used
+    when the runnable tasks are unknown.
+    While the host is not overloaded, the limit is increased by one for each sample;
+    as soon as it is, the limit is halved. After a decrease, the next one waits for `cooldown` seconds,
+    so that the previous decrease can take effect on the pressure. The limit stays within `[low, high]`.
+    """
+
+    def __init__(self, low: int, high: int, max_load: float = 1.0, min_memory: float = 0.1,
+                 max_pressure: float = 20.0, interval: float = 1.0, logger=None, cooldown: float = 10.0) -> None:
+        """Initialize the controller.
+
+        Args:
+            low (int): The minimum number of parallel tasks.
+            high (int): The maximum number of parallel tasks.
+            max_load (float): The maximum number of runnable tasks per CPU.
+            min_memory (float): The minimum fraction of available memory.
+            max_pressure (float): The maximum percentage of time stalled on CPU, memory or I/O (`some avg10`).
+            interval (float): The minimum number of seconds between two decisions.
+            logger (logging.Logger): Where the decisions are logged.
+            cooldown (float): The minimum number of seconds between two decreases.
+        """
+
+        if low < 1 or high < low:
+            raise ValueError('The bounds of concurrency must satisfy `1 <= min_workers <= max_workers`.')
+        self.low = low
+        self.high = high
+        self.max_load = max_load
+        self.min_memory = min_memory
+        self.max_pressure = max_pressure
+        self.interval = interval
+        self.logger = logger
+        self.cooldown = cooldown
+        self.cpus = os.cpu_count() or 1
+        self.limit = max(low, min(high, self.cpus))
+        self.__last = 0.0
+        self.__last_decrease = 0.0
+        self.__lock = threading.Lock()
+
+    @staticmethod
+    def sample() -> dict:
+        """Sample the load of the host, the values unavailable on the system are left out.
+
+        Returns:
+            dict: `load`, `runnable`, `memory` (available fraction) and `pressure` (`cpu`, `memory`, `io`).
+        """
+
+        res = {}
+        try:
+            with open('/proc/loadavg') as f:
+                fields = f.read().split()
+            res['load'] = float(fields[0])
+            # The number of runnable tasks, including the one reading
+            res['runnable'] = int(fields[3].split('/')[0]) - 1
+        except (OSError, IndexError, ValueError):
+            if hasattr(os, 'getloadavg'):
+                res['load'] = os.getloadavg()[0]
+        try:
+            meminfo = {}
+            with open('/proc/meminfo') as f:
+                for line in f:
+                    k, v = line.split(':', 1)
+                    meminfo[k] = int(v.split()[0])
+            res['memory'] = meminfo['MemAvailable'] / meminfo['MemTotal']
+        except (OSError, KeyError, ValueError, ZeroDivisionError):
+            pass
+        for resource in ('cpu', 'memory', 'io'):
+            try:
+                with open('/proc/pressure/{}'.format(resource)) as f:
+                    some = f.readline().split()
+                res.setdefault('pressure', {})[resource] = float(some[1].split('=')[1])
+            except (OSError, IndexError, ValueError):
+                pass
+        return res
+
+    def overloaded(self, sample: dict) -> str:
+        """Return the reason why the host is overloaded, or an empty string.
+        """
+
+        if 'runnable' not in sample and sample.get('load', 0) > self.max_load * self.cpus:
+            return 'load average {:.2f} > {:.2f}'.format(sample['load'], self.max_load * self.cpus)
+        if sample.get('runnable', 0) > self.max_load * self.cpus:
+            return 'runnable tasks {} > {:.2f}'.format(sample['runnable'], self.max_load * self.cpus)
+        if sample.get('memory', 1) < self.min_memory:
+            return 'available memory {:.1%} < {:.1%}'.format(sample['memory'], self.min_memory)
+        for resource, value in sorted(sample.get('pressure', {}).items()):
+            if value > self.max_pressure:
+                return '{} pressure {:.1f}% > {:.1f}%'.format(resource, value, self.max_pressure)
+        return ''
+
+    def update(self) -> int:
+        """Sample the host and adjust the limit, at most once per `interval`.
+
+        Returns:
+            int: The number of tasks allowed to run at the same time.
+        """
+
+        with self.__lock:
+            now = time.time()
+            if now - self.__last < self.interval:
+                return self.limit
+            self.__last = now
+            reason = self.overloaded(self.sample())
+            if reason:
+                if now - self.__last_decrease < self.cooldown:
+                    # The previous decrease has not taken effect yet
+                    return self.limit
+                limit = max(self.low, self.limit // 2)
+                if limit != self.limit:
+                    self.__last_decrease = now
+            else:
+                limit = min(self.high, self.limit + 1)
+            if limit != self.limit and self.logger:
+                self.logger.info('Concurrency {} -> {}: {}.'.format(
+                    self.limit, limit, reason or 'the host is not overloaded'))
+            self.limit = limit
+            return limit
 
 
 class ExecutionManager(PluginManager):
@@ -18,24 +200,255 @@ class ExecutionManager(PluginManager):
         super().__init__('execution', configManager)
         self.force = getattr(self, 'force', True)
         self.executable = getattr(self, 'executable', str(sys.executable))
+        # Split the CPUs between the tasks of a parallel list
+        self.partition = self.getattr('partition') is True if hasattr(self, 'partition') else False
+        # The placement applied to every task, overridden by the options of the task
+        self.placement = {k: getattr(self, k) for k in PLACEMENT_OPTIONS if getattr(self, k, '') != ''}
+        self.resolve(self.placement)
+        # The warnings already logged
+        self.__warned = set()
+        # The size of the thread pool, 0 means the default one of `ThreadPoolExecutor`
+        self.max_workers = int(getattr(self, 'max_workers', 0))
+        # Adapt the number of parallel tasks to the load of the host
+        self.adaptive = self.getattr('adaptive') is True if hasattr(self, 'adaptive') else False
+
+    def concurrency(self, workers: int, logger=None) -> Optional[AdaptiveConcurrency]:
+        """Create the controller of concurrency from the options, None if `adaptive` is not enabled.
 
-    def exec_command(self, command: str, log_manager: LogManager = None) -> int:
+        Args:
+            workers (int): The size of the thread pool, the upper bound of concurrency.
+            logger (logging.Logger): Where the decisions are logged.
+        """
+
+        if not self.adaptive:
+            return None
+        try:
+            return AdaptiveConcurrency(int(getattr(self, 'min_workers', 1)), workers,
+                                       float(getattr(self, 'max_load', 1.0)),
+                                       float(getattr(self, 'min_memory', 0.1)),
+                                       float(getattr(self, 'max_pressure', 20.0)),
+                                       float(getattr(self, 'interval', 1.0)), logger,
+                                       float(getattr(self, 'cooldown', 10.0)))
+        except (TypeError, ValueError) as e:
+            raise ValueError('Invalid options of adaptive concurrency: {}'.format(e))
+
+    def available_cpus(self, placement: Dict = None) -> Set[int]:
+        """Return the CPUs a task may run on.
+        """
+
+        placement = dict(self.placement, **(placement or {}))
+        if 'cpus' in placement:
+            return parse_cpus(placement['cpus'])
+        if hasattr(os, 'sched_getaffinity'):
+            return os.sched_getaffinity(0)
+        return set(range(os.cpu_count() or 1))
+
+    @staticmethod
+    def resolve(placement: Dict) -> Dict:
+        """Check the placement options and convert them to the values used at launch.
+
+        Args:
+            placement (dict): The options of `PLACEMENT_OPTIONS`.
+
+        Returns:
+            dict: The converted options.
+        """
+
+        res = {}
+        for k, v in placement.items():
+            if k not in PLACEMENT_OPTIONS:
+                raise ValueError('Unknown placement option `{}`.'.format(k))
+        if 'cpus' in placement:
+            res['cpus'] = parse_cpus(placement['cpus']) if isinstance(placement['cpus'], str) \
+                else set(placement['cpus'])
+        if 'nice' in placement:
+            try:
+                res['nice'] = int(placement['nice'])
+            except ValueError:
+                raise ValueError('`nice` must be an integer.')
+        if 'ionice' in placement:
+            # `class[,level]`, e.g. `idle` or `best-effort,7` or `2,7`
+            parts = [i.strip() for i in str(placement['ionice']).split(',')]
+            cls = IOPRIO_CLASSES.get(parts[0], parts[0])
+            try:
+                res['ionice'] = (int(cls), int(parts[1]) if len(parts) > 1 else 0)
+            except ValueError:
+                raise ValueError('`ionice` must be like `best-effort,7`.')
+        if 'cgroup' in placement:
+            res['cgroup'] = str(placement['cgroup'])
+        if 'cpu_max' in placement:
+            try:
+                # The number of CPUs, converted to the quota of `cpu.max` for a period of 100ms
+                res['cpu_max'] = '{} 100000'.format(int(float(placement['cpu_max']) * 100000))
+            except ValueError:
+                raise ValueError('`cpu_max` must be a number of CPUs.')
+        if 'memory_max' in placement:
+            res['memory_max'] = str(placement['memory_max'])
+        return res
+
+    def __warn(self, log_manager: LogManager, message: str) -> None:
+        """Log a warning once.
+        """
+
+        if message not in self.__warned:
+            self.__warned.add(message)
+            if log_manager and log_manager.enable:
+                log_manager.logger.warning(message)
+
+    def __cgroup(self, placement: Dict, log_manager: LogManager = None) -> Optional[str]:
+        """Create a child cgroup for the task under the delegated cgroup, return its path.
+
+        Returns None if the cgroup v2 delegation is not writable.
+        The limits whose controller is not available are ignored with a warning.
+        """
+
+        parent = placement['cgroup']
+        if not (os.path.exists(os.path.join(parent, 'cgroup.procs')) and os.access(parent, os.W_OK)):
+            self.__warn(log_manager, 'The cgroup `{}` is not writable, the cgroup limits are ignored.'.format(parent))
+            return None
+        limits = [(option, controller) for option, controller in (('cpu_max', 'cpu'), ('memory_max', 'memory'))
+                  if option in placement]
+        try:
+            with open(os.path.join(parent, 'cgroup.controllers')) as f:
+                available = f.read().split()
+            # Enable the controllers for the children, it may already be done by the delegation.
+            wanted = [c for _, c in limits if c in available]
+            if wanted:
+                with open(os.path.join(parent, 'cgroup.subtree_control'), 'w') as f:
+                    f.write(' '.join('+' + c for c in wanted))
+        except OSError:
+            pass
+        try:
+            with open(os.path.join(parent, 'cgroup.subtree_control')) as f:
+                enabled = f.read().split()
+        except OSError:
+            enabled = []
+
+        path = os.path.join(parent, 'louvijan-{}'.format(uuid.uuid4().hex[:12]))
+        os.mkdir(path)
+        try:
+            for option, controller in limits:
+                if controller not in enabled:
+                    self.__warn(log_manager, 'The controller `{}` is not enabled in the cgroup `{}`, '
+                                             '`{}` is ignored.'.format(controller, parent, option))
+                    continue
+                with open(os.path.join(path, '{}.max'.format(controller)), 'w') as f:
+                    f.write(placement[option])
+        except OSError:
+            os.rmdir(path)
+            raise
+        return path
+
+    def __apply(self, pid: int, placement: Dict, cgroup: Optional[str], log_manager: LogManager = None) -> None:
+        """Apply the placement to the process from the parent.
+
+        The placement which can't be applied (e.g. CPUs out of the affinity of `louvijan`,
+        a lower nice level without `CAP_SYS_NICE`) is ignored with a warning, the task still runs.
+        """
+
+        if cgroup:
+            try:
+                with open(os.path.join(cgroup, 'cgroup.procs'), 'w') as f:
+                    f.write(str(pid))
+            except OSError as e:
+                self.__warn(log_manager, 'Unable to move the tasks to the cgroup `{}`: {}'.format(cgroup, e))
+        if 'cpus' in placement and hasattr(os, 'sched_setaffinity'):
+            try:
+                os.sched_setaffinity(pid, placement['cpus'])
+            except OSError as e:
+                self.__warn(log_manager, 'Unable to run the tasks on the CPUs `{}`: {}'.format(
+                    ','.join(map(str, sorted(placement['cpus']))), e))
+        if 'nice' in placement:
+            try:
+                os.setpriority(os.PRIO_PROCESS, pid, placement['nice'])
+            except OSError as e:
+                self.__warn(log_manager, 'Unable to set the nice level to {}: {}'.format(placement['nice'], e))
+        if 'ionice' in placement and os.uname().machine in IOPRIO_SET:
+            import ctypes
+
+            syscall = ctypes.CDLL(None, use_errno=True).syscall
+            cls, level = placement['ionice']
+            # ioprio_set(IOPRIO_WHO_PROCESS, pid, IOPRIO_PRIO_VALUE(class, level))
+            if syscall(IOPRIO_SET[os.uname().machine], 1, pid, (cls << 13) | level) != 0:
+                self.__warn(log_manager, 'Unable to set the I/O priority: {}'.format(os.strerror(ctypes.get_errno())))
+
+    @staticmethod
+    def __release(fifo: str, proc: subprocess.Popen) -> None:
+        """Let the shell waiting on the FIFO go on with the command.
+        """
+
+        while True:
+            try:
+                fd = os.open(fifo, os.O_WRONLY | os.O_NONBLOCK)
+            except OSError as e:
+                # No reader yet, unless the shell is already dead
+                if e.errno != errno.ENXIO or proc.poll() is not None:
+                    return
+                time.sleep(0.001)
+            else:
+                os.write(fd, b'\n')
+                os.close(fd)
+                return
+
+    def exec_command(self, command: str, log_manager: LogManager = None, placement: Dict = None,
+                     cwd: str = None) -> int:
         """Execute the command and output to a log file or not.
 
         Args:
             command (str): Target command.
             log_manager (LogManager): Class `LogManager` instance.
+            placement (dict): The placement options of the task, override those of the `[execution]` section.
+            cwd (str): The working directory of the command, the current one if null.
 
         Returns:
             int：Status code returned by executing the command.
+
+        Notes:
+            The placement (CPU affinity, nice and ionice levels, cgroup limits) is only supported on Linux,
+            the options unsupported by the system are ignored.
+            No Python code runs in the forked child: the shell first waits on a FIFO, while the parent
+            applies the placement to it, and the command then inherits the placement from the shell.
         """
 
-        if log_manager:
-            with open(log_manager.path, 'a') as log:
+        placement = dict(self.placement, **(placement or {}))
+        if not placement or os.name != 'posix':
+            placement = {}
+        placement = self.resolve(placement)
+        cgroup = None
+        fifo_dir = None
+        try:
+            if placement:
+                if 'cgroup' in placement:
+                    cgroup = self.__cgroup(placement, log_manager)
+                fifo_dir = tempfile.mkdtemp(prefix='louvijan-')
+                fifo = os.path.join(fifo_dir, 'go')
+                os.mkfifo(fifo)
+                command = 'read _ < {}\n{}'.format(shlex.quote(fifo), command)
+
+            log = open(log_manager.path, 'a') if log_manager else None
+            try:
                 # The child process calls the system command and prints the error message to a log file.
-                ret = subprocess.call(command, shell=True, stdout=log, stderr=log)
-        else:
-            ret = subprocess.call(command, shell=True)
+                proc = subprocess.Popen(command, shell=True, cwd=cwd, stdout=log, stderr=log)
+                if placement:
+                    try:
+                        self.__apply(proc.pid, placement, cgroup, log_manager)
+                    except BaseException:
+                        proc.kill()
+                        proc.wait()
+                        raise
+                    finally:
+                        self.__release(fifo, proc)
+                ret = proc.wait()
+            finally:
+                log and log.close()
+        finally:
+            if fifo_dir:
+                shutil.rmtree(fifo_dir, ignore_errors=True)
+            if cgroup:
+                try:
+                    os.rmdir(cgroup)
+                except OSError:
+                    pass
 
         return ret
 
@@ -38,3 +38,11 @@ class LogManager(PluginManager):
             self.__console.setFormatter(self.__formatter)
             self.logger.addHandler(self.__rotatingHandler)
             self.logger.addHandler(self.__console)
+
+    def close(self) -> None:
+        """Remove the handlers of the logger and close the log file.
+        """
+
+        for handler in list(self.logger.handlers):
+            self.logger.removeHandler(handler)
+            handler.close()
@@ -1,7 +1,6 @@
 # coding=utf-8
 """mail.py - This module provides classes for handling mail.
 """
-import smtplib
 import traceback
 from email.header import Header
 from email.mime.text import MIMEText
@@ -35,6 +34,8 @@ class EMailManager(PluginManager):
             https://www.afternerd.com/blog/how-to-send-an-email-using-python-and-smtplib/
         """
 
+        import smtplib
+
         try:
             # acquire lock
             self.__class__._lock.acquire()
@@ -0,0 +1,196 @@
+# coding=utf-8
+"""metrics.py - This module exposes the metrics of running pipelines in Prometheus text format.
+
+Enable it in the configuration file and scrape `http://<host>:<port>/metrics`:
+
+    [metrics]
+    host = 127.0.0.1
+    port = 9464
+
+With `port = 0`, a free port is chosen and logged.
+"""
+import logging
+import sys
+import threading
+import weakref
+from collections import defaultdict
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from .base import PluginManager
+from .config import Config
+
+# The upper bounds (seconds) of the buckets of the task duration histogram.
+BUCKETS = (0.1, 0.5, 1, 5, 10, 30, 60, 300, 600, 1800, 3600, float('inf'))
+
+
+def _escape(value: str) -> str:
+    return str(value).replace('\\', '\\\\').replace('\n', '\\n').replace('"', '\\"')
+
+
+def _labels(**labels) -> str:
+    return '{' + ','.join('{}="{}"'.format(k, _escape(v)) for k, v in labels.items()) + '}'
+
+
+def _number(value: float) -> str:
+    if value == float('inf'):
+        return '+Inf'
+    return str(value) if isinstance(value, int) else repr(float(value))
+
+
+class Registry:
+    """The metrics collected in this process, shared by all `MetricsManager` objects.
+    """
+
+    def __init__(self) -> None:
+        self.lock = threading.Lock()
+        self.queued = defaultdict(int)
+        self.running = defaultdict(int)
+        self.succeeded = defaultdict(int)
+        self.failed = defaultdict(int)
+        # The size of the thread pools of the dispatching pipelines, keyed by pipeline name
+        self.workers = {}
+        # (pipeline, task) => [bucket counts, sum, count]
+        self.durations = {}
+        # The pipelines executing commands on remote servers
+        self.remotes = weakref.WeakSet()
+
+    def render(self) -> str:
+        """Render the metrics in Prometheus text format.
+        """
+
+        lines = []
+
+        def metric(name, kind, help, samples):
+            lines.append('# HELP {} {}'.format(name, help))
+            lines.append('# TYPE {} {}'.format(name, kind))
+            for labels, value in samples:
+                lines.append('{}{} {}'.format(name, labels, _number(value)))
+
+        with self.lock:
+            for name, help, values in (
+                    ('louvijan_tasks_queued', 'Tasks waiting to be executed.', self.queued),
+                    ('louvijan_tasks_running', 'Tasks being executed.', self.running)):
+                metric(name, 'gauge', help, [(_labels(pipeline=p), v) for p, v in sorted(values.items())])
+            for name, help, values in (
+                    ('louvijan_tasks_succeeded_total', 'Tasks executed successfully.', self.succeeded),
+                    ('louvijan_tasks_failed_total', 'Tasks failed.', self.failed)):
+                metric(name, 'counter', help, [(_labels(pipeline=p), v) for p, v in sorted(values.items())])
+            metric('louvijan_pool_workers', 'gauge', 'Size of the thread pool of the pipeline.',
+                   [(_labels(pipeline=p), v) for p, v in sorted(self.workers.items())])
+            metric('louvijan_pool_utilisation', 'gauge', 'Running tasks divided by the size of the thread pool.',
+                   [(_labels(pipeline=p), self.running[p] / v) for p, v in sorted(self.workers.items()) if v])
+
+            lines.append('# HELP louvijan_task_duration_seconds Duration of the tasks.')
+            lines.append('# TYPE louvijan_task_duration_seconds histogram')
+            for (pipeline, task), (buckets, total, count) in sorted(self.durations.items()):
+                for bound, n in zip(BUCKETS, buckets):
+                    lines.append('louvijan_task_duration_seconds_bucket{} {}'.format(
+                        _labels(pipeline=pipeline, task=task, le=_number(bound)), n))
+                lines.append('louvijan_task_duration_seconds_sum{} {}'.format(
+                    _labels(pipeline=pipeline, task=task), _number(total)))
+                lines.append('louvijan_task_duration_seconds_count{} {}'.format(
+                    _labels(pipeline=pipeline, task=task), count))
+
+            clients = {id(p.remote_manager.client) for p in self.remotes if p.connected}
+        # The clients kept alive by the daemon, if `louvijan.manager.remote` is loaded at all
+        remote = sys.modules.get('louvijan.manager.remote')
+        if remote is not None and remote.RemoteManager._clients is not None:
+            clients |= {id(c) for c in list(remote.RemoteManager._clients.values())}
+        metric('louvijan_remote_connections', 'gauge', 'Open connections to remote servers.', [('', len(clients))])
+        return '\n'.join(lines) + '\n'
+
+
+registry = Registry()
+
+
+class _Handler(BaseHTTPRequestHandler):
+
+    def do_GET(self) -> None:
+        if self.path.split('?')[0] not in ('/', '/metrics'):
+            self.send_error(404)
+            return
+        body = registry.render().encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args) -> None:
+        # Keep the scrapes out of the console
+        pass
+
+
+class MetricsManager(PluginManager):
+    """This class collects the metrics of the pipelines and serves them over HTTP.
+    """
+
+    # The HTTP servers started in this process, keyed by address
+    _servers = {}
+    _lock = threading.Lock()
+
+    def __init__(self, configManager: Config) -> None:
+        super().__init__('metrics', configManager)
+        self.host = getattr(self, 'host', '127.0.0.1')
+        self.port = int(getattr(self, 'port', 9464))
+        if self.enable:
+            self.serve()
+
+    def serve(self) -> None:
+        """Start the HTTP server in a daemon thread, once per address.
+
+        Notes:
+            If the address can't be bound (e.g. used by another run), a warning is logged
+            and the metrics are still collected, the pipeline is not affected.
+        """
+
+        cls = self.__class__
+        with cls._lock:
+            if (self.host, self.port) in cls._servers:
+                return
+            try:
+                server = ThreadingHTTPServer((self.host, self.port), _Handler)
+            except OSError as e:
+                logging.getLogger(__name__).warning('Unable to serve the metrics on `{}:{}`: {}'.format(
+                    self.host, self.port, e))
+                # Don't retry for every `PipeLine`
+                cls._servers[(self.host, self.port)] = None
+                return
+            server.daemon_threads = True
+            if self.port == 0:
+                logging.getLogger(__name__).info('Serve the metrics on `{}:{}`.'.format(
+                    self.host, server.server_address[1]))
+            threading.Thread(target=server.serve_forever, name='louvijan-metrics', daemon=True).start()
+            cls._servers[(self.host, self.port)] = server
+
+    def on_dispatch(self, pipeline) -> None:
+        with registry.lock:
+            registry.queued[pipeline.name] += pipeline.pending
+            registry.workers[pipeline.name] = pipeline.workers
+            pipeline.connected and registry.remotes.add(pipeline)
+
+    def on_task_start(self, pipeline, command: str) -> None:
+        with registry.lock:
+            # Tasks of a `PipeLine` which is not dispatched (e.g. called directly) were not counted as queued
+            registry.queued[pipeline.name] = max(0, registry.queued[pipeline.name] - 1)
+            registry.running[pipeline.name] += 1
+
+    def on_task_skip(self, pipeline, command: str) -> None:
+        with registry.lock:
+            registry.queued[pipeline.name] = max(0, registry.queued[pipeline.name] - 1)
+
+    def on_task_end(self, pipeline, command: str, ret: int, cost: float) -> None:
+        with registry.lock:
+            registry.running[pipeline.name] -= 1
+            if ret == 0:
+                registry.succeeded[pipeline.name] += 1
+            else:
+                registry.failed[pipeline.name] += 1
+            key = (pipeline.name, command)
+            if key not in registry.durations:
+                registry.durations[key] = [[0] * len(BUCKETS), 0.0, 0]
+            histogram = registry.durations[key]
+            for i, bound in enumerate(BUCKETS):
+                if cost <= bound:
+                    histogram[0][i] += 1
+            histogram[1] += cost
+            histogram[2] += 1
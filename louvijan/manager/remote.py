@@ -1,31 +1,97 @@
 # coding=utf-8
 """remote.py - This module provides classes for remote servers.
 """
-import paramiko
+import hashlib
+import json
+import os
+import posixpath
+import shlex
+import stat
+import uuid
 from .config import Config
 from .base import PluginManager
 from .log import LogManager
 
+# The maximum size in bytes of a command run on the remote server while syncing.
+# The command is a single argument of `sh -c`, which Linux limits to 128 KiB.
+SCRIPT_LIMIT = 64 * 1024
+
 
 class RemoteManager(PluginManager):
     """This class is used to operate on a remote server.
+
+    Two transports are supported and chosen by the option `transport`:
+    `ssh` (default) runs commands through `paramiko`,
+    `agent` submits them to a `louvijan` agent running on the remote server (see `louvijan.agent`).
     """
 
+    # The digests of local files, keyed by path, size and modification time,
+    # so a file synced to several servers is only read once.
+    _hashes = {}
+    # The connected clients shared by all `RemoteManager` objects, keyed by server.
+    # Only set by the daemon of `louvijan.server`, so that SSH transports are kept alive between runs.
+    _clients = None
+
     def __init__(self, configManager: Config) -> None:
         super().__init__('remote', configManager)
         self.connected = False
         self.client = None
+        self.transport = getattr(self, 'transport', 'ssh')
+        self.agent_port = int(getattr(self, 'agent_port', 7391))
+        self.token = getattr(self, 'token', '')
+        # Upload the scripts and inputs to a content-addressed cache on the remote server before running.
+        self.sync = self.getattr('sync') is True if hasattr(self, 'sync') else False
+        self.cache_dir = getattr(self, 'cache_dir', '.louvijan/cache')
+        self.inputs = [i.strip() for i in getattr(self, 'inputs', '').split(',') if i.strip()]
+        # The home directory on the remote server, known once synced
+        self.home = None
 
     def connect(self, log_manager: LogManager = None) -> None:
         """Connect to remote server.
 
         The main steps are as follows:
-        1. Instantiate the class `SSHClient`;
-        2. Call the method `connect` of the `SSHClient` class;
+        1. Instantiate the class `SSHClient`, or `AgentClient` for the `agent` transport;
+        2. Call the method `connect` of the `SSHClient` class, or `ping` the agent;
         3. If the connection fails, the exception information will be output in the log file;
         otherwise set `connected` to true, which means Successfully connected.
         """
 
+        cls = self.__class__
+        if self.transport == 'agent':
+            key = (self.transport, self.ip, self.agent_port, self.__secret(self.token))
+        else:
+            key = (self.transport, self.ip, getattr(self, 'port', None), getattr(self, 'username', None),
+                   self.__secret(getattr(self, 'password', '')))
+        if cls._clients is not None and key in cls._clients:
+            client = cls._clients[key]
+            transport = client.get_transport() if self.transport != 'agent' else None
+            if self.transport == 'agent' or (transport is not None and transport.is_active()):
+                self.client = client
+                self.connected = True
+                return
+            del cls._clients[key]
+
+        self.__connect(log_manager)
+        if self.connected and cls._clients is not None:
+            cls._clients[key] = self.client
+
+    def __connect(self, log_manager: LogManager = None) -> None:
+        if self.transport == 'agent':
+            from ..agent import AgentClient
+
+            self.client = AgentClient(self.ip, self.agent_port, self.token)
+            try:
+                self.client.ping()
+            except Exception as e:
+                if log_manager and log_manager.enable:
+                    log_manager.logger.error('Unable to connect the agent on `{}:{}`: {}'.format(
+                        self.ip, self.agent_port, e))
+            else:
+                self.connected = True
+            return
+
+        import paramiko
+
         self.client = paramiko.SSHClient()
 
         # Automatically add a policy to save the host name and key information for the server.
@@ -53,18 +119,240 @@ class RemoteManager(PluginManager):
             int: The status code returned after executing the command.
         """
 
+        if self.transport == 'agent':
+            return self.__exec_on_agent(command, log_manager)
+
         stdin, stdout, stderr = self.client.exec_command(command)
         output_str = stdout.read().decode('utf-8')
         err_str = stderr.read().decode('utf-8').strip()
-        _remote_out_format = 'Execute on the remote server with IP `{}`'
+        _remote_out_format = 'Execute on the remote server with IP `{}`\n{}'
         _remote_err_format = 'Failed to execute on the remote server with IP `{}`\n{}'
 
         if log_manager and log_manager.enable:
             if output_str:
-                log_manager.info(_remote_out_format.format(self.ip, output_str))
+                log_manager.logger.info(_remote_out_format.format(self.ip, output_str))
             if err_str:
-                log_manager.error(_remote_err_format.format(self.ip, err_str))
+                log_manager.logger.error(_remote_err_format.format(self.ip, err_str))
 
         ret = 0 if err_str == '' else -1
 
         return ret
+
+    def __exec_on_agent(self, command: str, log_manager: LogManager = None) -> int:
+        """Execute the command through the agent and log its output as it is streamed back.
+        """
+
+        logger = log_manager.logger if log_manager and log_manager.enable else None
+
+        def on_output(stream, line):
+            if logger:
+                log = logger.error if stream == 'stderr' else logger.info
+                log('[{}] {}'.format(self.ip, line.rstrip('\n')))
+
+        ret, rusage = self.client.run(command, on_output, cwd=self.home or '~')
+        if logger and rusage:
+            logger.info('Execute on the agent `{}` with user time {:.2f}s, system time {:.2f}s, max RSS {} KB.'.format(
+                self.ip, rusage['utime'], rusage['stime'], rusage['maxrss']))
+        return ret
+
+    def upload(self, paths, log_manager: LogManager = None, cwd: str = None):
+        """Upload files to the remote server through SFTP, skipping the ones already there.
+
+        Args:
+            paths (iterable): Local files or directories, a relative path keeps relative to the remote home.
+            log_manager (LogManager): Class `LogManager` instance.
+            cwd (str): The local directory the relative paths are relative to, the current one if null.
+
+        Returns:
+            tuple: The number of uploaded and skipped files.
+
+        Raises:
+            FileNotFoundError: If a path doesn't exist locally.
+            IOError: If the files can't be put in place on the remote server.
+
+        Notes:
+            Each file is stored once in `cache_dir` under the SHA-256 of its content, then copied
+            to the target path on the server, which is a regular file so that the imports of a script
+            keep resolving against its own directory. A manifest in `cache_dir` records the digest,
+            size and modification time of every target, so when nothing has changed,
+            a repeat run only costs an `lstat` per file.
+        """
+
+        # Tuples of `(local path, path relative to the remote home)`
+        files = []
+        for path in paths:
+            local = os.path.join(cwd, path) if cwd else path
+            if os.path.isdir(local):
+                for root, _, names in os.walk(local):
+                    files.extend((os.path.join(root, name), os.path.join(path, os.path.relpath(
+                        os.path.join(root, name), local))) for name in names)
+            elif os.path.isfile(local):
+                files.append((local, path))
+            else:
+                raise FileNotFoundError('No such file or directory to sync: `{}`.'.format(path))
+
+        uploaded = skipped = 0
+        sftp = self.__open_sftp()
+        try:
+            # The commands of the agent transport run in the remote home too, as those of SSH do
+            self.home = sftp.normalize('.')
+            cache_dir = self.__makedirs(sftp, self.cache_dir)
+            manifest_path = posixpath.join(cache_dir, 'manifest.json')
+            try:
+                with sftp.open(manifest_path, 'r') as f:
+                    manifest = json.loads(f.read().decode('utf-8'))
+            except (IOError, ValueError):
+                manifest = {}
+
+            copies = []
+            for local, name in files:
+                target = posixpath.join(self.home, name.replace(os.sep, '/'))
+                digest = self.__hash(local)
+                obj = posixpath.join(cache_dir, digest)
+                try:
+                    attr = sftp.lstat(target)
+                except IOError:
+                    attr = None
+                if attr is not None and stat.S_ISDIR(attr.st_mode):
+                    raise IOError('Unable to sync `{}`: the target is a directory on the remote server.'.format(target))
+                if attr is not None and stat.S_ISREG(attr.st_mode) and \
+                        manifest.get(target) == [digest, attr.st_size, attr.st_mtime]:
+                    skipped += 1
+                    continue
+                try:
+                    sftp.stat(obj)
+                except IOError:
+                    # Upload to a temporary name first, so that an interrupted upload is never taken for the object.
+                    tmp = '{}.{}.tmp'.format(obj, uuid.uuid4().hex)
+                    sftp.put(local, tmp)
+                    sftp.posix_rename(tmp, obj)
+                    uploaded += 1
+                else:
+                    skipped += 1
+                copies.append((obj, target, digest))
+
+            if copies:
+                # Replace whatever is at the target (a regular file of a previous deploy, a symlink...)
+                # with a copy of the object, in as few remote commands as the limit of arguments allows.
+                for script in self.__batch(copies):
+                    status, err = self.__run(script)
+                    if status != 0:
+                        raise IOError('Unable to copy the files from the cache on `{}`: {}'.format(self.ip, err))
+                for _, target, digest in copies:
+                    attr = sftp.lstat(target)
+                    manifest[target] = [digest, attr.st_size, attr.st_mtime]
+                with sftp.open(manifest_path, 'w') as f:
+                    f.write(json.dumps(manifest).encode('utf-8'))
+        finally:
+            sftp.close()
+
+        if log_manager and log_manager.enable:
+            log_manager.logger.info('Sync to the remote server with IP `{}`: {} uploaded, {} unchanged.'.format(
+                self.ip, uploaded, skipped))
+        return uploaded, skipped
+
+    @staticmethod
+    def __batch(copies):
+        """Group the copies into shell scripts no longer than `SCRIPT_LIMIT` bytes.
+        """
+
+        batch, size = [], 0
+        for obj, target, _ in copies:
+            step = 'mkdir -p {dir} && cp {obj} {tmp} && mv -f {tmp} {target}'.format(
+                dir=shlex.quote(posixpath.dirname(target)), obj=shlex.quote(obj),
+                tmp=shlex.quote('{}.{}.tmp'.format(target, uuid.uuid4().hex[:8])),
+                target=shlex.quote(target))
+            if batch and size + len(step.encode('utf-8')) + 4 > SCRIPT_LIMIT:
+                yield ' && '.join(batch)
+                batch, size = [], 0
+            batch.append(step)
+            size += len(step.encode('utf-8')) + 4
+        if batch:
+            yield ' && '.join(batch)
+
+    def __run(self, command: str):
+        """Run a command on the remote server, return its exit status and error output.
+        """
+
+        if self.transport == 'agent':
+            err = []
+            status, _ = self.client.run(command, lambda stream, line: stream == 'stderr' and err.append(line),
+                                        cwd=self.home or '~')
+            return status, ''.join(err)
+        stdin, stdout, stderr = self.client.exec_command(command)
+        err = stderr.read().decode('utf-8')
+        return stdout.channel.recv_exit_status(), err
+
+    def __open_sftp(self):
+        """Open an SFTP session, through a dedicated SSH connection for the `agent` transport.
+
+        Notes:
+            With the `agent` transport, the SSH connection uses the options `port` (22 by default),
+            `username` (the local user by default) and `password`, or the local SSH keys and agent.
+        """
+
+        if self.transport != 'agent':
+            return self.client.open_sftp()
+
+        import paramiko
+
+        port = int(getattr(self, 'port', 22))
+        client = paramiko.SSHClient()
+        client.set_missing_host_key_policy(paramiko.AutoAddPolicy())
+        try:
+            client.connect(hostname=self.ip, port=port, username=getattr(self, 'username', None),
+                           password=getattr(self, 'password', None), timeout=5)
+        except Exception as e:
+            client.close()
+            raise IOError('Unable to sync to `{}`: the `agent` transport syncs through SSH on port {}, '
+                          'check the options `username` and `password` or the SSH keys: {}'.format(self.ip, port, e))
+        sftp = client.open_sftp()
+        # Close the connection along with the session.
+        sftp.close = lambda close=sftp.close: (close(), client.close())
+        return sftp
+
+    @staticmethod
+    def __makedirs(sftp, path: str) -> str:
+        """Create the remote directory and its parents if needed, return its absolute path.
+        """
+
+        if not path:
+            return sftp.normalize('.')
+        parts = path.split('/')
+        current = '/' if path.startswith('/') else ''
+        for part in filter(None, parts):
+            current = posixpath.join(current, part)
+            try:
+                sftp.stat(current)
+            except IOError:
+                sftp.mkdir(current)
+        return sftp.normalize(current)
+
+    @staticmethod
+    def __secret(value: str) -> str:
+        """Return the digest of a credential, so that the keys of `_clients` don't hold it in clear.
+        """
+
+        return hashlib.sha256(str(value).encode('utf-8')).hexdigest()
+
+    @classmethod
+    def __hash(cls, path: str) -> str:
+        stat = os.stat(path)
+        key = (os.path.abspath(path), stat.st_size, stat.st_mtime_ns)
+        if key in cls._hashes:
+            return cls._hashes[key]
+        sha = hashlib.sha256()
+        with open(path, 'rb') as f:
+            for chunk in iter(lambda: f.read(1 << 20), b''):
+                sha.update(chunk)
+        cls._hashes[key] = sha.hexdigest()
+        return cls._hashes[key]
+
+    def close(self) -> None:
+        """Close the connection to the remote server.
+        """
+
+        # The shared clients are kept open
+        if self.client is not None and self.__class__._clients is None:
+            self.client.close()
+        self.connected = False
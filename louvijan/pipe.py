@@ -1,17 +1,21 @@
 # coding=utf-8
 """pipe.py - The core module of `louvijan`.
 """
+import os
+import threading
 import time
 import traceback
 from concurrent.futures.thread import ThreadPoolExecutor
-from concurrent.futures import as_completed
+from concurrent.futures import as_completed, wait, FIRST_COMPLETED
 from queue import Queue
+from .manager import load_managers
 from .manager.config import Config
-from .manager.log import LogManager
-from .manager.remote import RemoteManager
-from .manager.mail import EMailManager
-from .manager.execution import ExecutionManager
-from typing import List, Union, Tuple, Callable
+from .manager.execution import partition_cpus
+from typing import List, Optional, Union, Tuple, Callable
+
+# The context of the current thread, `louvijan.server` puts the running job here,
+# so that the `PipeLine` objects created by a submitted pipeline can be cancelled.
+_context = threading.local()
 
 
 class PipeLine:
@@ -19,28 +23,52 @@ class PipeLine:
     """
 
     # The number of `Pipeline` objects.
+    # Inside the daemon of `louvijan.server`, `_count`, `_errors` and `_time` are those of the job instead.
     _count = 1
     # List of global error messages stored
     _errors = []
     # Record the start time of execution
     _time = time.time()
-
-    def __init__(self, *args: Union[str, List, Callable], **kwargs):
+    # Limits the number of commands running at the same time across all `PipeLine` objects,
+    # set by `louvijan.server` to share the daemon's concurrency limit. No limit if None.
+    _slots = None
+    # `Config` is a singleton, the configuration is loaded and read under this lock,
+    # so that the `PipeLine` objects built at the same time (e.g. by the daemon) don't mix their configuration.
+    _lock = threading.Lock()
+
+    def __init__(self, *args: Union[str, List, Tuple, Callable], **kwargs):
         """Initialize each component.
 
         Args:
-            args (str or list): Sequence and combination of commands.
+            args (str or list or tuple): Sequence and combination of commands.
+            A tuple `(name, options)` sets the placement options of the task, e.g. `('B.py', {'cpus': '0-1'})`,
+            see `ExecutionManager` for the options.
             config='': The path to the configuration file,
             if null, the default configuration is provided.
         """
 
         config_path = kwargs.pop('config', '')
-
-        self.config_manager = Config(config_path)
-        self.execution_manager = ExecutionManager(self.config_manager)
-        self.log_manager = LogManager(self.config_manager)
-        self.remote_manager = RemoteManager(self.config_manager)
-        self.email_manager = EMailManager(self.config_manager)
+        # The job of `louvijan.server` this `PipeLine` belongs to, if any
+        self.__job = getattr(_context, 'job', None)
+        # Where `_count`, `_errors` and `_time` are kept
+        self.__scope = self.__job or self.__class__
+        if self.__job and config_path:
+            # Relative paths are relative to the working directory of the submitter
+            config_path = os.path.join(self.__job.cwd, config_path)
+
+        with self.__class__._lock:
+            self.config_manager = Config(config_path)
+            if self.__job and self.config_manager.manager.has_option('log', 'path'):
+                # The log file too is relative to the working directory of the submitter
+                self.config_manager.manager.set('log', 'path', os.path.join(
+                    self.__job.cwd.replace('%', '%%'), self.config_manager.manager.get('log', 'path', raw=True)))
+            # The managers of the sections in the configuration file, keyed by section
+            self.managers = load_managers(self.config_manager)
+        self.execution_manager = self.managers['execution']
+        self.log_manager = self.managers['log']
+        # None if the section is absent, so that their dependencies are never imported
+        self.remote_manager = self.managers.get('remote')
+        self.email_manager = self.managers.get('email')
 
         # When an error is encountered, whether to FORCE the operation to continue
         # If true, it means that whether there is an exception or an error, it will be executed to the end.
@@ -53,22 +81,30 @@ class PipeLine:
         self.start = time.time()
         # The queue that stores tasks
         self.__queue = Queue()
-        # Parallel tasks are executed by thread pool
-        self.__executor = ThreadPoolExecutor()
+        # Parallel tasks are executed by thread pool, whose size is the default one of `ThreadPoolExecutor`
+        self.workers = self.execution_manager.max_workers or min(32, (os.cpu_count() or 1) + 4)
+        self.__executor = ThreadPoolExecutor(max_workers=self.workers)
         self.__logger = self.log_manager.logger if self.log_manager.enable else None
+        # Adapts the number of parallel tasks to the load of the host, None if disabled
+        self.__concurrency = self.execution_manager.concurrency(self.workers, self.__logger)
         # The executable command to execute (Python) scripts
         self.__executable = self.execution_manager.executable
+        # The script names, which are uploaded to the remote server when `sync` is enabled
+        self.__scripts = []
         # Resolves the script names to commands
         for arg in args:
             self.__cmd = ''
             if isinstance(arg, self.__class__):
-                self.__class__._count += 1
+                self.__scope._count += 1
                 self.__queue.put(arg)
             elif isinstance(arg, list):
                 self.__cmd = self.__flatten(arg)
+            elif isinstance(arg, tuple):
+                self.__cmd = self.__task(arg)
             elif isinstance(arg, str):
                 name = arg.strip()
                 if name:
+                    self.__scripts.append(name)
                     self.__cmd = '{} {}'.format(self.__executable, name)
                 else:
                     raise ValueError("Filename or command can't be None.")
@@ -76,15 +112,68 @@ class PipeLine:
                 raise TypeError('Error input type for filename or command.')
             self.__cmd != '' and self.__queue.put(self.__cmd)
 
-        if self.remote_manager.enable:
+        if self.remote_manager and self.remote_manager.enable:
             self.remote_manager.connect(self.log_manager)
 
     def __call__(self, *args, **kwargs):
+        self.sync()
         self.dispatch()
 
+    @property
+    def pending(self) -> int:
+        """The number of commands waiting to be executed, excluding those of the nested `PipeLine` objects.
+        """
+
+        count = 0
+        for item in list(self.__queue.queue):
+            for sub in item if isinstance(item, list) else [item]:
+                count += isinstance(sub, (str, tuple))
+        return count
+
+    @property
+    def connected(self) -> bool:
+        """Whether the commands are executed on a remote server.
+        """
+
+        return self.remote_manager is not None and self.remote_manager.connected
+
+    def __send_mail(self, message: str) -> None:
+        if self.email_manager is not None:
+            self.email_manager.send(message)
+
+    def __notify(self, hook: str, *args) -> None:
+        """Call the hook of every manager, see `PluginManager` for the hooks.
+        """
+
+        for manager in self.managers.values():
+            try:
+                getattr(manager, hook)(self, *args)
+            except Exception:
+                traceback.print_exc()
+
     def __rshift__(self, other):
         pass
 
+    def __task(self, arg: Tuple) -> Tuple[str, dict]:
+        """Resolve a task with placement options to its command.
+
+        Args:
+            arg (tuple): `(name, options)`.
+
+        Returns:
+            tuple: The command and the placement options.
+        """
+
+        if len(arg) != 2 or not isinstance(arg[0], str) or not isinstance(arg[1], dict):
+            raise TypeError('A task with options must be a tuple `(name, dict)`.')
+        name = arg[0].strip()
+        if not name:
+            raise ValueError("Filename or command can't be None.")
+        # Check the options now rather than at launch
+        self.execution_manager.resolve(arg[1])
+        self.__scripts.append(name)
+        return '{} {}'.format(self.__executable, name), arg[1]
+
     def __flatten(self, input_arr: List[Union[str, List]]) -> List[Union[str, List]]:
         """Flatten out the nested structure of the script list.
 
@@ -115,21 +204,41 @@ class PipeLine:
                     if i != '':
                         tmp_output_arr.append(i)
                         if isinstance(i, self.__class__):
-                            self.__class__._count += 1
+                            self.__scope._count += 1
                     input_arr.pop(index)
                     break
 
         # Concatenates the executable command with the script name
         for item in tmp_output_arr:
-            if isinstance(item, str):
+            if isinstance(item, tuple):
+                output_arr.append(self.__task(item))
+            elif isinstance(item, str):
+                self.__scripts.append(item)
                 output_arr.append('{} {}'.format(self.__executable, str(item)))
             else:
                 output_arr.append(item)
 
         return output_arr
 
+    @property
+    def __cwd(self) -> Optional[str]:
+        """The working directory of the commands, the one of the submitter inside the daemon.
+        """
+
+        return self.__job.cwd if self.__job else None
+
+    @property
+    def cancelled(self) -> bool:
+        """Whether the job this `PipeLine` belongs to has been cancelled.
+        """
+
+        return self.__job is not None and self.__job.cancel.is_set()
+
     def __do_task(self, cmd):
-        self.__exec_cmd(cmd)
+        if not self.cancelled:
+            self.__exec_cmd(cmd)
+        elif isinstance(cmd, (str, tuple)):
+            self.__notify('on_task_skip', cmd[0] if isinstance(cmd, tuple) else cmd)
 
     def __exec_cmd(self, command: Union[str, Tuple, Callable]) -> None:
         """Execute the command.
@@ -143,24 +252,35 @@ class PipeLine:
             if it is a `PipeLine` class object, it will be scheduled.
         """
         # The parameters passed in the submit method of ThreadPoolExecutor can be tuples
+        placement = None
         if isinstance(command, tuple):
-            command = command[0]
+            command, placement = command[0], (command[1] if len(command) > 1 else None)
         if isinstance(command, self.__class__):
             command.dispatch()
-        if isinstance(command, str):
+        elif isinstance(command, str):
             ret = -1
+            slots = self.__class__._slots
             try:
+                slots and slots.acquire()
+                self.__notify('on_task_start', command)
                 start = time.time()
-                if self.remote_manager.connected:
-                    if self.log_manager.enable:
-                        self.remote_manager.exec_command(command, self.log_manager)
-                else:
-                    if self.log_manager.enable:
-                        ret = self.execution_manager.exec_command(command, self.log_manager)
+                try:
+                    if self.connected:
+                        if self.log_manager.enable:
+                            ret = self.remote_manager.exec_command(command, self.log_manager)
+                        else:
+                            ret = self.remote_manager.exec_command(command)
                     else:
-                        ret = self.execution_manager.exec_command(command)
-
-                end = time.time()
+                        if self.log_manager.enable:
+                            ret = self.execution_manager.exec_command(command, self.log_manager, placement, self.__cwd)
+                        else:
+                            ret = self.execution_manager.exec_command(command, placement=placement, cwd=self.__cwd)
+                except Exception:
+                    # The command could not be executed, it is counted as failed
+                    traceback.print_exc()
+                finally:
+                    end = time.time()
+                    self.__notify('on_task_end', command, ret, end - start)
 
                 if ret == 0:
                     # Calculate the elapsed time for the script to run
@@ -168,18 +288,125 @@ class PipeLine:
                     self.__logger and self.__logger.info('{}\nRun successfully and cost {} seconds.\n'.format(command, cost))
                 else:
                     err = '{}\nRun Failed.\n'.format(command)
-                    self.__logger.error(err)
-                    self.__class__._errors.append((ret, err))
+                    self.__logger and self.__logger.error(err)
+                    self.__scope._errors.append((ret, err))
                     self.errors.append((ret, err))
+                    self.__job and self.__job.errors.append(err)
                     # If no enforcement is set, the message is sent and the program is forcibly terminated
                     if not self.force:
-                        self.email_manager.send(err)
-                        self.execution_manager.kill()
+                        self.__send_mail(err)
+                        if self.__job:
+                            # Inside the daemon, only the job is terminated
+                            self.__job.cancel.set()
+                        else:
+                            self.execution_manager.kill()
             except Exception as e:
                 traceback.print_exc()
+            finally:
+                slots and slots.release()
         else:
             raise TypeError('Command Type error: it must be `str` or `PipeLine` or `tuple`.')
 
+    def __sync_jobs(self) -> List[Tuple]:
+        """Collect the files to upload for this `PipeLine` and the nested ones.
+
+        Returns:
+            list: Tuples of `(remote_manager, log_manager, paths)`.
+        """
+
+        import shlex
+
+        jobs = []
+        if self.connected and self.remote_manager.sync:
+            paths = list(self.remote_manager.inputs)
+            for name in self.__scripts:
+                # The script name may be followed by its arguments
+                script = shlex.split(name)[0] if name.strip() else ''
+                if os.path.isfile(os.path.join(self.__cwd or '', script)):
+                    paths.append(script)
+            jobs.append((self.remote_manager, self.log_manager, paths))
+        for item in list(self.__queue.queue):
+            for sub in item if isinstance(item, list) else [item]:
+                if isinstance(sub, self.__class__):
+                    jobs.extend(sub.__sync_jobs())
+        return jobs
+
+    def sync(self) -> None:
+        """Upload the scripts and inputs to the remote servers that enable `sync`.
+
+        Raises:
+            IOError: If any server fails to sync, after all of them are done,
+            so that no script is run against stale files.
+
+        Notes:
+            Files of the pipelines running on the same server are uploaded together,
+            and different servers are synced in parallel.
+        """
+
+        hosts = {}
+        for remote_manager, log_manager, paths in self.__sync_jobs():
+            key = (remote_manager.ip, remote_manager.getattr('port') if hasattr(remote_manager, 'port') else 22)
+            if key in hosts:
+                hosts[key][2].extend(p for p in paths if p not in hosts[key][2])
+            else:
+                hosts[key] = (remote_manager, log_manager, list(dict.fromkeys(paths)))
+        if not hosts:
+            return
+        failed = []
+        with ThreadPoolExecutor(max_workers=len(hosts)) as executor:
+            tasks = {executor.submit(remote_manager.upload, paths, log_manager, self.__cwd):
+                     (remote_manager, log_manager)
+                     for remote_manager, log_manager, paths in hosts.values()}
+            for task in as_completed(tasks):
+                try:
+                    task.result()
+                except Exception as e:
+                    remote_manager, log_manager = tasks[task]
+                    err = 'Sync to the remote server with IP `{}` failed: {}\n'.format(remote_manager.ip, e)
+                    log_manager.enable and log_manager.logger.error(err)
+                    self.__scope._errors.append((-1, err))
+                    self.errors.append((-1, err))
+                    failed.append(err)
+        if failed:
+            raise IOError(''.join(failed).strip())
+
+    def __partition(self, item: List) -> List:
+        """Give each command of a parallel list its own share of the CPUs, unless it sets `cpus` itself.
+        """
+
+        commands = [i for i in item if isinstance(i, (str, tuple))]
+        if not commands:
+            return item
+        shares = iter(partition_cpus(self.execution_manager.available_cpus(), len(commands)))
+        res = []
+        for i in item:
+            if isinstance(i, (str, tuple)):
+                command, placement = (i, {}) if isinstance(i, str) else i
+                cpus = next(shares)
+                if 'cpus' not in placement:
+                    placement = dict(placement, cpus=cpus)
+                i = (command, placement)
+            res.append(i)
+        return res
+
+    def __dispatch_adaptive(self, item: List) -> None:
+        """Execute a parallel list, keeping no more tasks in flight than the controller of concurrency allows.
+        """
+
+        pending = list(reversed(item))
+        running = set()
+        while pending or running:
+            limit = self.__concurrency.update()
+            while pending and len(running) < limit:
+                running.add(self.__executor.submit(self.__do_task, pending.pop()))
+            # Wake up regularly to follow the load of the host, even if no task completes
+            done, running = wait(running, timeout=self.__concurrency.interval, return_when=FIRST_COMPLETED)
+            for task in done:
+                try:
+                    task.result()
+                except Exception as e:
+                    traceback.print_exc()
+
     def dispatch(self) -> None:
         """Dispatch and schedule parallel tasks.
 
@@ -199,22 +426,28 @@ class PipeLine:
         The main steps of the method are as follows:
 
         1. Pop items from queue in turn util it is empty;
-        2. If the type of item is `str`, execute it directly;
+        2. If the type of item is `str` or `tuple`, execute it directly;
            in case of `Pipeline`, call the `dispatch` method to execute recursively;
            for `list`, submit the task to the thread pool and wait for it to complete.
         """
 
         self.start = time.time()
-        while not self.__queue.empty():
+        self.__notify('on_dispatch')
+        while not self.__queue.empty() and not self.cancelled:
             item = self.__queue.get()
             ret = -1
-            if isinstance(item, str):
+            if isinstance(item, (str, tuple)):
                 self.__exec_cmd(item)
             if isinstance(item, self.__class__):
                 # Recursively dispatch
                 item.dispatch()
             # `list` represents parallel execution
             elif isinstance(item, list):
+                if self.execution_manager.partition:
+                    item = self.__partition(item)
+                if self.__concurrency:
+                    self.__dispatch_adaptive(item)
+                    continue
                 # Commit the task to the thread pool
                 tasks = [self.__executor.submit(self.__do_task, i) for i in item]
                 # Wait for the tasks to complete
@@ -227,6 +460,12 @@ class PipeLine:
                     except Exception as e:
                         task.cancel()
                         traceback.print_exc()
+        # The commands left when the job is cancelled are never executed
+        while not self.__queue.empty():
+            item = self.__queue.get()
+            for sub in item if isinstance(item, list) else [item]:
+                if isinstance(sub, (str, tuple)):
+                    self.__notify('on_task_skip', sub[0] if isinstance(sub, tuple) else sub)
 
     def __format_msg(self, g=True) -> str:
         """Format the output information at the end of the execution.
@@ -238,7 +477,7 @@ class PipeLine:
             str: The information to output.
         """
 
-        obj = self.__class__ if g else self
+        obj = self.__scope if g else self
         error_attr = '_errors' if g else 'errors'
         start_time_attr = '_time' if g else 'start'
         if not hasattr(obj, error_attr):
@@ -268,13 +507,17 @@ class PipeLine:
         such as writing logs, calculating elapsed time, and sending emails etc.
         """
 
-        if self.remote_manager.connected:
-            self.remote_manager.client.close()
-        cls = self.__class__
-        cls._count -= 1
+        if not hasattr(self, 'remote_manager'):
+            # The initialization failed
+            return
+        if self.connected:
+            self.remote_manager.close()
+        scope = self.__scope
+        scope._count -= 1
         # When the last `PipeLine` object is released
-        if cls._count == 0:
-            self.email_manager.send(self.__format_msg())
+        if scope._count == 0:
+            self.__send_mail(self.__format_msg())
         else:
             msg = self.__format_msg(g=False)
-            self.email_manager.send(msg)
+            self.__send_mail(msg)
+        self.log_manager.close()
@@ -0,0 +1,232 @@
+# coding=utf-8
+"""server.py - The long-running scheduler daemon of `louvijan`.
+
+The daemon keeps the interpreter, the imported modules, the SSH transports and
+the history of runs alive, and executes the pipelines submitted through a Unix socket.
+All the pipelines share the same limit on the number of commands running at the same time.
+
+A pipeline is submitted either as a Python file (e.g. `pipeline.py` calling `PipeLine(...)()`)
+or as a JSON file describing the tasks:
+
+    {"config": "remote.conf", "tasks": ["a.py", ["b.py", "c.py"], {"tasks": ["d.py"], "config": "x.conf"}, "e.py"]}
+
+where a list means parallel execution and an object a nested `PipeLine`.
+
+The protocol is one JSON request line answered by one JSON response line.
+"""
+import itertools
+import json
+import os
+import runpy
+import socket
+import socketserver
+import threading
+import time
+import traceback
+from concurrent.futures.thread import ThreadPoolExecutor
+from typing import List, Union
+
+from . import pipe
+from .manager.remote import RemoteManager
+
+# The default path of the Unix socket.
+DEFAULT_SOCKET = os.environ.get('LOUVIJAN_SOCKET', os.path.join(os.path.expanduser('~'), '.louvijan', 'louvijan.sock'))
+
+
+class Job:
+    """A pipeline submitted to the daemon and its state.
+    """
+
+    def __init__(self, id: int, path: str, cwd: str) -> None:
+        self.id = id
+        self.path = path
+        # The working directory of the submitter, where the commands of the job run
+        self.cwd = cwd
+        # One of `queued`, `running`, `succeeded`, `failed` and `cancelled`
+        self.status = 'queued'
+        self.submitted = time.time()
+        self.started = None
+        self.finished = None
+        # The error messages of the failed commands
+        self.errors = []
+        # Set to stop the job before its next command
+        self.cancel = threading.Event()
+        self.future = None
+        # The counters of `PipeLine`, scoped to the job instead of the process
+        self._count = 1
+        self._errors = []
+        self._time = time.time()
+
+    def to_dict(self) -> dict:
+        return {'id': self.id, 'path': self.path, 'status': self.status,
+                'submitted': self.submitted, 'started': self.started, 'finished': self.finished,
+                'errors': self.errors}
+
+
+def build(spec: Union[dict, list], base: str = '') -> pipe.PipeLine:
+    """Build a `PipeLine` from its JSON description.
+
+    Args:
+        spec (dict or list): `{"tasks": [...], "config": "..."}`, or the list of tasks only.
+        base (str): The directory the configuration paths are relative to.
+
+    Returns:
+        PipeLine: The pipeline described.
+    """
+
+    if isinstance(spec, list):
+        spec = {'tasks': spec}
+    config = spec.get('config', '')
+    if config:
+        config = os.path.join(base, config)
+
+    def convert(task):
+        if isinstance(task, dict):
+            return build(task, base)
+        if isinstance(task, list):
+            return [convert(i) for i in task]
+        return task
+
+    # The nested pipelines must be built before the configuration of this one is loaded,
+    # because `Config` is a singleton.
+    tasks = [convert(i) for i in spec.get('tasks', [])]
+    return pipe.PipeLine(*tasks, config=config)
+
+
+class _Handler(socketserver.StreamRequestHandler):
+    """Serve one request of the CLI.
+    """
+
+    def handle(self) -> None:
+        try:
+            request = json.loads(self.rfile.readline().decode('utf-8'))
+            op = request.get('op')
+            if op == 'submit':
+                response = {'job': self.server.submit(request['path'], request.get('cwd')).to_dict()}
+            elif op == 'list':
+                response = {'jobs': [job.to_dict() for job in self.server.list()]}
+            elif op == 'cancel':
+                response = {'job': self.server.cancel(int(request['id'])).to_dict()}
+            else:
+                response = {'error': 'Unknown operation `{}`.'.format(op)}
+        except Exception as e:
+            response = {'error': str(e)}
+        self.wfile.write((json.dumps(response) + '\n').encode('utf-8'))
+
+
+class Server(socketserver.ThreadingUnixStreamServer):
+    """The scheduler daemon.
+    """
+
+    daemon_threads = True
+
+    def __init__(self, path: str = DEFAULT_SOCKET, workers: int = 0, pipelines: int = 4) -> None:
+        """Initialize the daemon.
+
+        Args:
+            path (str): The path of the Unix socket.
+            workers (int): The maximum number of commands running at the same time,
+            shared by all pipelines. If 0, the number of CPUs is used.
+            pipelines (int): The maximum number of pipelines running at the same time,
+            the others are queued.
+
+        Raises:
+            OSError: If another daemon is listening on the socket.
+        """
+
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        if os.path.exists(path):
+            with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+                try:
+                    sock.connect(path)
+                except OSError:
+                    # Left by a daemon which is not running any more
+                    os.remove(path)
+                else:
+                    raise OSError('A daemon is already listening on `{}`.'.format(path))
+        self.path = path
+        self.jobs = {}
+        self.__ids = itertools.count(1)
+        self.__lock = threading.Lock()
+        self.__executor = ThreadPoolExecutor(max_workers=pipelines)
+        pipe.PipeLine._slots = threading.BoundedSemaphore(workers or os.cpu_count() or 1)
+        # Keep the connections to the remote servers alive between runs
+        RemoteManager._clients = {}
+        super().__init__(path, _Handler)
+
+    def submit(self, path: str, cwd: str = None) -> Job:
+        """Queue the pipeline file for execution.
+
+        Args:
+            path (str): The pipeline file.
+            cwd (str): The working directory of the submitter, the directory of the file if null.
+        """
+
+        if not os.path.isfile(path):
+            raise FileNotFoundError('No such pipeline file: `{}`.'.format(path))
+        path = os.path.abspath(path)
+        with self.__lock:
+            job = Job(next(self.__ids), path, cwd or os.path.dirname(path))
+            self.jobs[job.id] = job
+            job.future = self.__executor.submit(self.__run, job)
+        return job
+
+    def list(self) -> List[Job]:
+        return list(self.jobs.values())
+
+    def cancel(self, id: int) -> Job:
+        """Cancel a queued job, or stop a running one before its next command.
+
+        Notes:
+            The commands already running are left to finish.
+        """
+
+        if id not in self.jobs:
+            raise ValueError('No such job: {}.'.format(id))
+        job = self.jobs[id]
+        job.cancel.set()
+        if job.future.cancel():
+            job.status = 'cancelled'
+            job.finished = time.time()
+        return job
+
+    def __run(self, job: Job) -> None:
+        job.status = 'running'
+        job.started = job._time = time.time()
+        pipe._context.job = job
+        try:
+            if job.path.endswith('.json'):
+                with open(job.path, encoding='utf-8') as f:
+                    spec = json.load(f)
+                build(spec, os.path.dirname(job.path))()
+            else:
+                runpy.run_path(job.path, run_name='__main__')
+        except BaseException:
+            job.errors.append(traceback.format_exc())
+        finally:
+            pipe._context.job = None
+        if job.cancel.is_set() and not job.errors:
+            job.status = 'cancelled'
+        else:
+            job.status = 'failed' if job.errors else 'succeeded'
+        job.finished = time.time()
+
+    def server_close(self) -> None:
+        super().server_close()
+        self.__executor.shutdown(wait=False)
+        if os.path.exists(self.path):
+            os.remove(self.path)
+
+
+def request(message: dict, path: str = DEFAULT_SOCKET) -> dict:
+    """Send a request to the daemon and return its response.
+    """
+
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+        sock.connect(path)
+        sock.sendall((json.dumps(message) + '\n').encode('utf-8'))
+        with sock.makefile('rb') as f:
+            response = json.loads(f.readline().decode('utf-8'))
+    if 'error' in response:
+        raise RuntimeError(response['error'])
+    return response
@@ -0,0 +1,109 @@
+# coding=utf-8
+import json
+import socket
+import sys
+import threading
+
+import pytest
+
+from louvijan.agent import AgentClient, AgentError, AgentServer, _digest
+
+pytestmark = pytest.mark.skipif(sys.platform == 'win32', reason='The agent is tested on POSIX only.')
+
+TOKEN = 'secret'
+
+
+@pytest.fixture
+def server():
+    srv = AgentServer(TOKEN, '127.0.0.1', 0, workers=1)
+    threading.Thread(target=srv.serve_forever, daemon=True).start()
+    yield srv
+    srv.shutdown()
+    srv.server_close()
+
+
+def test_run(server):
+    client = AgentClient('127.0.0.1', server.server_address[1], TOKEN)
+    lines = []
+    status, rusage = client.run('echo hello; echo oops >&2; exit 3', lambda stream, line: lines.append((stream, line)))
+    client.close()
+    assert status == 3
+    assert ('stdout', 'hello\n') in lines
+    assert ('stderr', 'oops\n') in lines
+    assert set(rusage) == {'utime', 'stime', 'maxrss'}
+
+
+def test_wrong_token(server):
+    client = AgentClient('127.0.0.1', server.server_address[1], 'wrong')
+    with pytest.raises(AgentError):
+        client.ping()
+
+
+def test_coordinator_disconnects_mid_run(server):
+    sock = socket.create_connection(server.server_address)
+    rfile = sock.makefile('rb')
+    nonce = json.loads(rfile.readline())['nonce']
+    sock.sendall((json.dumps({'type': 'auth', 'digest': _digest(TOKEN, nonce)}) + '\n').encode('utf-8'))
+    assert json.loads(rfile.readline())['type'] == 'ready'
+    sock.sendall(b'{"type": "run", "command": "yes | head -c 20000000"}\n')
+    rfile.close()
+    sock.close()
+
+    # The only slot of the pool must be released once the agent notices the coordinator is gone
+    assert server.slots.acquire(timeout=10)
+    server.slots.release()
+    client = AgentClient('127.0.0.1', server.server_address[1], TOKEN)
+    assert client.run('true')[0] == 0
+    client.close()
+
+
+def test_command_fails_to_start(server, tmp_path):
+    client = AgentClient('127.0.0.1', server.server_address[1], TOKEN)
+    lines = []
+    status, _ = client.run('true', lambda stream, line: lines.append((stream, line)), cwd=str(tmp_path / 'missing'))
+    assert status == 127
+    assert lines[0][0] == 'stderr' and 'missing' in lines[0][1]
+    # The connection is still usable
+    assert client.run('true')[0] == 0
+    client.close()
+
+
+def test_run_without_command(server):
+    sock = socket.create_connection(server.server_address)
+    rfile = sock.makefile('rb')
+    nonce = json.loads(rfile.readline())['nonce']
+    sock.sendall((json.dumps({'type': 'auth', 'digest': _digest(TOKEN, nonce)}) + '\n').encode('utf-8'))
+    assert json.loads(rfile.readline())['type'] == 'ready'
+    sock.sendall(b'{"type": "run"}\n')
+    assert json.loads(rfile.readline())['type'] == 'error'
+    sock.sendall(b'{"type": "ping"}\n')
+    assert json.loads(rfile.readline())['type'] == 'pong'
+    rfile.close()
+    sock.close()
+
+
+def test_warm_worker(tmp_path):
+    srv = AgentServer(TOKEN, '127.0.0.1', 0, workers=1, pool=1, preload=['decimal'])
+    threading.Thread(target=srv.serve_forever, daemon=True).start()
+    (tmp_path / 'helper.py').write_text('VALUE = 1\n')
+    (tmp_path / 'main.py').write_text('import sys\nimport helper\n'
+                                      'print("decimal" in sys.modules, sys.argv[1:], helper.VALUE)\nsys.exit(3)\n')
+    client = AgentClient('127.0.0.1', srv.server_address[1], TOKEN)
+    try:
+        for _ in range(2):
+            lines = []
+            status, rusage = client.run('{} main.py a b'.format(sys.executable),
+                                        lambda stream, line: lines.append(line), cwd=str(tmp_path))
+            # Run by a worker which imported `decimal` in advance, and replaced after each task
+            assert status == 3
+            assert lines == ["True ['a', 'b'] 1\n"]
+            assert rusage is not None
+        # The commands which need a shell are not run by the workers
+        lines = []
+        assert client.run('{} main.py | cat'.format(sys.executable), lambda stream, line: lines.append(line),
+                          cwd=str(tmp_path))[0] == 0
+        assert lines == ["False [] 1\n"]
+    finally:
+        client.close()
+        srv.shutdown()
+        srv.server_close()
@@ -0,0 +1,33 @@
+# coding=utf-8
+from louvijan.manager.execution import AdaptiveConcurrency
+
+
+def controller(sample, **kwargs):
+    c = AdaptiveConcurrency(1, 8, interval=0, **kwargs)
+    c.cpus = 4
+    c.sample = lambda: sample
+    return c
+
+
+def test_increase_while_healthy():
+    c = controller({'load': 0.0, 'runnable': 1, 'memory': 0.5, 'pressure': {'cpu': 0.0}})
+    c.limit = 1
+    assert [c.update() for _ in range(3)] == [2, 3, 4]
+    assert [c.update() for _ in range(10)][-1] == 8
+
+
+def test_decrease_waits_for_cooldown():
+    c = controller({'load': 0.0, 'runnable': 1, 'memory': 0.5, 'pressure': {'io': 80.0}}, cooldown=60)
+    c.limit = 8
+    # Only one decrease until the cooldown expires
+    assert [c.update() for _ in range(5)] == [4, 4, 4, 4, 4]
+
+
+def test_lagging_load_average_is_ignored():
+    c = controller({'load': 100.0, 'runnable': 1, 'memory': 0.5})
+    c.limit = 2
+    assert c.update() == 3
+    # Without the runnable tasks, the load average is the only signal left
+    c = controller({'load': 100.0}, cooldown=0)
+    c.limit = 8
+    assert [c.update() for _ in range(2)] == [4, 2]
@@ -0,0 +1,88 @@
+# coding=utf-8
+import os
+import shutil
+import sys
+
+import pytest
+
+from louvijan.manager.config import Config
+from louvijan.manager.execution import ExecutionManager, parse_cpus, partition_cpus
+
+linux = pytest.mark.skipif(not sys.platform.startswith('linux'), reason='The placement is supported on Linux only.')
+
+
+@pytest.fixture
+def manager(tmp_path):
+    conf = tmp_path / 'e.conf'
+    conf.write_text('[execution]\nname = e\nforce = true\n')
+    return ExecutionManager(Config(str(conf)))
+
+
+def test_parse_and_partition_cpus():
+    assert parse_cpus('0-2, 5') == {0, 1, 2, 5}
+    assert partition_cpus({0, 1, 2, 3}, 2) == [{0, 1}, {2, 3}]
+    assert partition_cpus({0}, 3) == [{0}, {0}, {0}]
+    with pytest.raises(ValueError):
+        parse_cpus('a-b')
+
+
+@linux
+def test_affinity_and_nice(manager, tmp_path):
+    out = tmp_path / 'out'
+    cpu = min(os.sched_getaffinity(0))
+    script = '{} -c "import os; print(sorted(os.sched_getaffinity(0)), os.getpriority(os.PRIO_PROCESS, 0))" > {}'.format(
+        sys.executable, out)
+    assert manager.exec_command(script, placement={'cpus': str(cpu), 'nice': 7}) == 0
+    assert out.read_text().split('\n')[0] == '[{}] 7'.format(cpu)
+
+
+@linux
+@pytest.mark.skipif(shutil.which('ionice') is None, reason='`ionice` is not installed.')
+def test_ionice(manager, tmp_path):
+    out = tmp_path / 'out'
+    assert manager.exec_command('ionice -p $$ > {}'.format(out), placement={'ionice': 'best-effort,6'}) == 0
+    assert out.read_text().strip() == 'best-effort: prio 6'
+
+
+@linux
+def test_unavailable_cgroup_controllers(manager, tmp_path):
+    # A delegated cgroup without the `memory` controller
+    cgroup = tmp_path / 'cgroup'
+    cgroup.mkdir()
+    (cgroup / 'cgroup.procs').write_text('')
+    (cgroup / 'cgroup.controllers').write_text('cpu\n')
+    assert manager.exec_command('true', placement={'cgroup': str(cgroup), 'memory_max': '1G'}) == 0
+    # The limit is ignored instead of failing the task
+    children = [name for name in os.listdir(str(cgroup)) if name.startswith('louvijan-')]
+    assert not [name for name in children if os.path.exists(str(cgroup / name / 'memory.max'))]
+
+
+@linux
+def test_placement_failure_still_runs(tmp_path):
+    (tmp_path / 'a.py').write_text('open({!r}, "w")\n'.format(str(tmp_path / 'ran')))
+    log = tmp_path / 'p.log'
+    conf = tmp_path / 'p.conf'
+    conf.write_text('[execution]\nname = e\nforce = true\n[log]\npath = {}\n'.format(log))
+    from louvijan import PipeLine
+
+    # The CPU doesn't exist, the task runs without affinity
+    pipeline = PipeLine((str(tmp_path / 'a.py'), {'cpus': '9999'}), config=str(conf))
+    pipeline()
+    assert (tmp_path / 'ran').exists()
+    assert pipeline.errors == []
+    assert 'Unable to run the tasks on the CPUs `9999`' in log.read_text()
+
+
+def test_failed_launch_is_an_error(tmp_path, monkeypatch):
+    conf = tmp_path / 'p.conf'
+    conf.write_text('[execution]\nname = e\nforce = true\n')
+    from louvijan import PipeLine
+
+    pipeline = PipeLine('a.py', config=str(conf))
+
+    def fail(*args, **kwargs):
+        raise OSError('launch failed')
+
+    monkeypatch.setattr(pipeline.execution_manager, 'exec_command', fail)
+    pipeline()
+    assert len(pipeline.errors) == 1
@@ -0,0 +1,54 @@
+# coding=utf-8
+import socket
+import urllib.request
+
+from louvijan import PipeLine
+from louvijan.manager.metrics import MetricsManager
+
+
+def test_metrics(tmp_path):
+    (tmp_path / 'a.py').write_text('print(1)\n')
+    conf = tmp_path / 'm.conf'
+    conf.write_text('[execution]\nname = metrics\nforce = true\n[metrics]\nhost = 127.0.0.1\nport = 0\n')
+    PipeLine(str(tmp_path / 'a.py'), config=str(conf))()
+
+    server = MetricsManager._servers[('127.0.0.1', 0)]
+    body = urllib.request.urlopen('http://127.0.0.1:{}/metrics'.format(server.server_address[1])).read().decode()
+    assert 'louvijan_tasks_succeeded_total{pipeline="metrics"} 1' in body
+    assert 'louvijan_task_duration_seconds_count{pipeline="metrics",' in body
+
+
+def test_port_in_use(tmp_path):
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        sock.listen()
+        port = sock.getsockname()[1]
+        (tmp_path / 'a.py').write_text('print(1)\n')
+        conf = tmp_path / 'm.conf'
+        conf.write_text('[execution]\nname = busy\nforce = true\n[metrics]\nhost = 127.0.0.1\nport = {}\n'.format(port))
+        pipeline = PipeLine(str(tmp_path / 'a.py'), config=str(conf))
+        pipeline()
+        assert pipeline.errors == []
+
+
+def test_cancelled_tasks_are_not_queued(tmp_path, monkeypatch):
+    from louvijan import pipe
+    from louvijan.manager.metrics import registry
+    from louvijan.server import Job
+
+    conf = tmp_path / 'm.conf'
+    conf.write_text('[execution]\nname = cancelled\nforce = true\nmax_workers = 1\n'
+                    '[metrics]\nhost = 127.0.0.1\nport = 0\n')
+    job = Job(1, str(tmp_path / 'p.py'), str(tmp_path))
+    monkeypatch.setattr(pipe._context, 'job', job, raising=False)
+    pipeline = PipeLine(['a.py', 'b.py', 'c.py'], 'd.py', config=str(conf))
+
+    def cancel(*args, **kwargs):
+        job.cancel.set()
+        return 0
+
+    monkeypatch.setattr(pipeline.execution_manager, 'exec_command', cancel)
+    pipeline.dispatch()
+    # The first task cancels the job, the others are skipped
+    assert registry.succeeded['cancelled'] == 1
+    assert registry.queued['cancelled'] == 0
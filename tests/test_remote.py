@@ -0,0 +1,182 @@
+# coding=utf-8
+import gc
+import os
+import shutil
+import subprocess
+import sys
+import threading
+
+import pytest
+
+from louvijan.agent import AgentServer, AgentClient
+from louvijan.manager.config import Config
+from louvijan.manager.remote import RemoteManager
+
+pytestmark = pytest.mark.skipif(sys.platform == 'win32', reason='The remote server is emulated on POSIX only.')
+
+
+class LocalSFTP:
+    """An SFTP session on the local file system, whose home is `root`.
+    """
+
+    def __init__(self, root):
+        self.root = root
+
+    def _path(self, path):
+        return path if path.startswith('/') else os.path.join(self.root, path)
+
+    def normalize(self, path):
+        return os.path.normpath(self._path(path))
+
+    def stat(self, path):
+        return os.stat(self._path(path))
+
+    def lstat(self, path):
+        return os.lstat(self._path(path))
+
+    def mkdir(self, path):
+        os.mkdir(self._path(path))
+
+    def put(self, local, remote):
+        shutil.copy(local, self._path(remote))
+
+    def posix_rename(self, old, new):
+        os.rename(self._path(old), self._path(new))
+
+    def open(self, path, mode='r'):
+        return open(self._path(path), mode + 'b')
+
+    def close(self):
+        pass
+
+
+@pytest.fixture
+def remote(tmp_path, monkeypatch):
+    home = tmp_path / 'remote'
+    home.mkdir()
+    server = AgentServer('secret', '127.0.0.1', 0)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+
+    conf = tmp_path / 'remote.conf'
+    conf.write_text('[remote]\nip = 127.0.0.1\ntransport = agent\nagent_port = {}\ntoken = secret\n'
+                    'sync = true\n'.format(server.server_address[1]))
+    manager = RemoteManager(Config(str(conf)))
+    manager.client = AgentClient('127.0.0.1', server.server_address[1], 'secret')
+    monkeypatch.setattr(manager, '_RemoteManager__open_sftp', lambda: LocalSFTP(str(home)))
+    monkeypatch.chdir(tmp_path)
+    yield manager, home
+    manager.client.close()
+    server.shutdown()
+    server.server_close()
+
+
+def test_upload_skips_unchanged_files(remote, tmp_path):
+    manager, home = remote
+    (tmp_path / 'proj').mkdir()
+    (tmp_path / 'proj' / 'main.py').write_text('import helper\nprint(helper.VALUE)\n')
+    (tmp_path / 'proj' / 'helper.py').write_text('VALUE = 1\n')
+
+    assert manager.upload(['proj']) == (2, 0)
+    assert manager.upload(['proj']) == (0, 2)
+    (tmp_path / 'proj' / 'helper.py').write_text('VALUE = 2\n')
+    assert manager.upload(['proj']) == (1, 1)
+
+    # The targets are regular files, so the sibling imports resolve in the directory of the script
+    assert not os.path.islink(str(home / 'proj' / 'main.py'))
+    out = subprocess.check_output([sys.executable, str(home / 'proj' / 'main.py')])
+    assert out.strip() == b'2'
+
+
+def test_upload_replaces_existing_files(remote, tmp_path):
+    manager, home = remote
+    (home / 'a.py').write_text('old\n')
+    (tmp_path / 'a.py').write_text('new\n')
+
+    assert manager.upload(['a.py']) == (1, 0)
+    assert (home / 'a.py').read_text() == 'new\n'
+
+
+def test_agent_runs_in_remote_home(remote, tmp_path):
+    manager, home = remote
+    (tmp_path / 'a.py').write_text('print(1)\n')
+    manager.upload(['a.py'])
+    assert manager.exec_command('test -f a.py') == 0
+
+
+def test_upload_many_files(remote, tmp_path):
+    manager, home = remote
+    tree = tmp_path / 'tree'
+    for i in range(30):
+        (tree / 'd{:02}'.format(i)).mkdir(parents=True)
+        for j in range(100):
+            (tree / 'd{:02}'.format(i) / 'f{:03}.txt'.format(j)).write_text('{} {}\n'.format(i, j))
+
+    # The copies don't fit in the single argument of `sh -c`
+    assert manager.upload(['tree']) == (3000, 0)
+    assert (home / 'tree' / 'd29' / 'f099.txt').read_text() == '29 99\n'
+    assert manager.upload(['tree']) == (0, 3000)
+
+
+def test_upload_rejects_missing_inputs(remote, tmp_path):
+    manager, home = remote
+    with pytest.raises(FileNotFoundError):
+        manager.upload(['missing.csv'])
+
+
+def test_sync_failure_stops_pipeline(remote, tmp_path, monkeypatch):
+    manager, home = remote
+    (tmp_path / 'a.py').write_text('open("ran", "w")\n')
+    conf = tmp_path / 'p.conf'
+    conf.write_text('[execution]\nname = sync\nforce = true\n[log]\npath = {}\n[remote]\nip = 127.0.0.1\n'
+                    'transport = agent\nagent_port = {}\ntoken = secret\nsync = true\ninputs = missing.csv\n'.format(
+                        tmp_path / 'p.log', manager.agent_port))
+    from louvijan import PipeLine
+
+    pipeline = PipeLine('a.py', config=str(conf))
+    assert pipeline.connected
+    with pytest.raises(IOError):
+        pipeline()
+    assert not (tmp_path / 'ran').exists()
+    assert 'missing.csv' in pipeline.errors[0][1]
+    assert 'missing.csv' in (tmp_path / 'p.log').read_text()
+    # Release the pipeline now, the exception keeps it in a reference cycle
+    del pipeline
+    gc.collect()
+
+
+def test_shared_clients_per_agent(tmp_path, monkeypatch):
+    servers = [AgentServer(token, '127.0.0.1', 0) for token in ('a', 'b')]
+    for server in servers:
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+    monkeypatch.setattr(RemoteManager, '_clients', {})
+    ports = []
+    try:
+        for server, token in zip(servers, ('a', 'b')):
+            conf = tmp_path / '{}.conf'.format(token)
+            conf.write_text('[remote]\nip = 127.0.0.1\ntransport = agent\nagent_port = {}\ntoken = {}\n'.format(
+                server.server_address[1], token))
+            manager = RemoteManager(Config(str(conf)))
+            manager.connect()
+            assert manager.connected
+            ports.append((server.server_address[1], manager.client.port))
+        # Each configuration gets the client of its own agent
+        assert all(port == client_port for port, client_port in ports)
+    finally:
+        for client in RemoteManager._clients.values():
+            client.close()
+        for server in servers:
+            server.shutdown()
+            server.server_close()
+
+
+def test_upload_relative_to_cwd(remote, tmp_path, monkeypatch):
+    manager, home = remote
+    (tmp_path / 'proj' / 'conf').mkdir(parents=True)
+    (tmp_path / 'proj' / 'a.py').write_text('print(1)\n')
+    (tmp_path / 'proj' / 'conf' / 'x.ini').write_text('x\n')
+    monkeypatch.chdir(str(home))
+
+    # As the daemon does for a job submitted from `proj`
+    assert manager.upload(['a.py', 'conf'], cwd=str(tmp_path / 'proj')) == (2, 0)
+    assert (home / 'a.py').read_text() == 'print(1)\n'
+    assert (home / 'conf' / 'x.ini').read_text() == 'x\n'
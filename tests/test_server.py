@@ -0,0 +1,84 @@
+# coding=utf-8
+import sys
+import threading
+import time
+
+import pytest
+
+from louvijan import PipeLine
+from louvijan.manager.remote import RemoteManager
+from louvijan.server import Server, request
+
+pytestmark = pytest.mark.skipif(sys.platform == 'win32', reason='The daemon listens on a Unix socket.')
+
+
+@pytest.fixture
+def server(tmp_path):
+    srv = Server(str(tmp_path / 'louvijan.sock'), workers=2)
+    threading.Thread(target=srv.serve_forever, daemon=True).start()
+    yield srv
+    srv.shutdown()
+    srv.server_close()
+    PipeLine._slots = None
+    RemoteManager._clients = None
+
+
+def wait(srv, id, timeout=30):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        job = request({'op': 'list'}, srv.path)['jobs'][id - 1]
+        if job['status'] not in ('queued', 'running'):
+            return job
+        time.sleep(0.1)
+    raise TimeoutError
+
+
+def test_tasks_run_in_submitter_cwd(server, tmp_path):
+    proj = tmp_path / 'proj'
+    proj.mkdir()
+    (proj / 'c.py').write_text('print(1)\n')
+    (tmp_path / 'p.json').write_text('{"tasks": ["c.py", ["c.py", "c.py"]]}')
+    (tmp_path / 'p.py').write_text('from louvijan import PipeLine\nPipeLine("c.py")()\n')
+
+    count = PipeLine._count
+    for i, name in enumerate(('p.json', 'p.py')):
+        request({'op': 'submit', 'path': str(tmp_path / name), 'cwd': str(proj)}, server.path)
+        assert wait(server, i + 1)['status'] == 'succeeded'
+    # The counters of `PipeLine` are scoped to the jobs
+    assert PipeLine._count == count
+    # The default log file is written in the working directory of the submitter
+    assert 'c.py' in (proj / 'louvijan.log').read_text()
+
+
+def test_failed_job(server, tmp_path):
+    (tmp_path / 'p.json').write_text('{"tasks": ["missing.py"]}')
+    request({'op': 'submit', 'path': str(tmp_path / 'p.json'), 'cwd': str(tmp_path)}, server.path)
+    job = wait(server, 1)
+    assert job['status'] == 'failed'
+    assert 'missing.py' in job['errors'][0]
+
+
+def test_concurrent_configurations(tmp_path):
+    for name in 'AB':
+        (tmp_path / '{}.conf'.format(name)).write_text('[execution]\nname = {}\nforce = true\n'.format(name))
+    wrong = []
+
+    def build(name):
+        for _ in range(200):
+            p = PipeLine('a.py', config=str(tmp_path / '{}.conf'.format(name)))
+            if p.name != name:
+                wrong.append(p.name)
+
+    threads = [threading.Thread(target=build, args=(name,)) for name in 'AB']
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    assert not wrong
+
+
+def test_socket_in_use(server):
+    with pytest.raises(OSError):
+        Server(server.path)
+    # The running daemon is still reachable
+    assert request({'op': 'list'}, server.path)['jobs'] == []
@@ -0,0 +1,36 @@
+# coding=utf-8
+import json
+import os
+import subprocess
+import sys
+
+# The budget of `import louvijan`, in seconds
+IMPORT_BUDGET = 0.25
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+CODE = '''
+import json, sys, time
+start = time.perf_counter()
+import louvijan
+cost = time.perf_counter() - start
+print(json.dumps({'cost': cost, 'modules': sorted(sys.modules)}))
+'''
+
+
+def run(code):
+    env = dict(os.environ, PYTHONPATH=ROOT)
+    return json.loads(subprocess.check_output([sys.executable, '-c', code], env=env, cwd=ROOT))
+
+
+def test_import_is_lazy():
+    res = run(CODE)
+    for module in ('paramiko', 'smtplib', 'louvijan.manager.remote', 'louvijan.manager.mail',
+                   'louvijan.agent', 'louvijan.server'):
+        assert module not in res['modules']
+
+
+def test_import_budget():
+    # The best of a few runs, to keep the noise of the machine out
+    cost = min(run(CODE)['cost'] for _ in range(3))
+    assert cost < IMPORT_BUDGET, 'import louvijan took {:.3f}s'.format(cost)